@@ -0,0 +1,61 @@
+"""Import time of each synth_auto_map module, and a guard against heavy dependencies being imported eagerly.
+
+Each module is imported in a fresh interpreter. Exits with status 1 if a module pulls in a dependency it should only
+load on first use, or if an import takes longer than --max-seconds.
+
+    python benchmarks/bench_import.py --max-seconds 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# dependencies that must not be loaded just by importing each module
+DEFERRED = {
+    "synth_auto_map": ["librosa", "spleeter", "tensorflow", "matplotlib", "mplcyberpunk", "pandas"],
+    "synth_auto_map.audio_trip_conversion": ["librosa", "spleeter", "tensorflow", "matplotlib", "mplcyberpunk",
+                                             "pandas"],
+    "synth_auto_map.beat_finder": ["spleeter", "tensorflow", "scipy.stats", "matplotlib", "mplcyberpunk",
+                                   "pandas"],
+    "synth_auto_map.cache": ["librosa", "spleeter", "tensorflow", "matplotlib", "mplcyberpunk", "pandas"],
+    "synth_auto_map.instrumentation": ["librosa", "spleeter", "tensorflow", "matplotlib", "mplcyberpunk", "pandas"],
+    "synth_auto_map.jobs": ["spleeter", "tensorflow", "scipy.stats", "matplotlib", "mplcyberpunk",
+                            "pandas"],
+    "synth_auto_map.serialization": ["librosa", "spleeter", "tensorflow", "matplotlib", "mplcyberpunk", "pandas"],
+    "synth_auto_map.streaming": ["spleeter", "tensorflow", "matplotlib", "mplcyberpunk", "pandas"],
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module):
+    """Import a module in a new interpreter, return import time and any deferred dependencies that were loaded"""
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, deferred=DEFERRED[module])],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-seconds", type=float, default=None, help="fail if any import takes longer")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<40} {'seconds':>8}  eagerly loaded")
+    for module in DEFERRED:
+        result = measure(module)
+        print(f"{module:<40} {result['seconds']:>8.3f}  {', '.join(result['loaded']) or '-'}")
+        if result["loaded"] or (args.max_seconds is not None and result["seconds"] > args.max_seconds):
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Time each stage of the analysis-to-export pipeline and the Audio Trip conversion, and track peak memory.
+
+Inputs are synthetic click tracks, tone bursts and .ats files, so this runs offline on CPU. Results can be saved as a
+baseline and later runs compared against it, e.g. before and after upgrading librosa or numpy:
+
+    python benchmarks/bench_pipeline.py --save-baseline baseline.json
+    python benchmarks/bench_pipeline.py --baseline baseline.json --tolerance 1.25
+
+Exits with status 1 if any stage is slower or uses more memory than the baseline allows.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import librosa
+
+from synth_auto_map.audio_trip_conversion import all_rails, decode_choreography, load_ats, validate_rails
+from synth_auto_map.beat_finder import MapConversion, write_beatmap
+from synth_auto_map.cache import library_versions
+
+from synthetic import write_audio, write_ats
+
+
+def measure(f, repeat):
+    """
+    Fastest wall time of several runs, then the peak traced allocation of one more run
+
+    :return: result of the last run, seconds, peak megabytes
+    """
+    times = []
+    for _ in range(repeat):
+        # as in timeit, so collection of earlier stages' objects isn't charged to this one
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+        gc.enable()
+
+    # traced separately, tracing slows allocations down
+    tracemalloc.start()
+    result = f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(times), peak / 1024 ** 2
+
+
+def drop_features(converter, *names):
+    """Forget analysis features of the standard signal so the next access recomputes them"""
+    features = converter._analysis_cache.get((None, converter.samplingrate, converter.hop_length), {})
+    for name in names:
+        features.pop(name, None)
+
+
+def audio_stages(path, bpm, output):
+    """Stages of MapConversion, each run on the results of the ones before it"""
+    state = {}
+
+    def load():
+        state["y"], state["sr"] = librosa.load(path, sr=22050)
+
+    def onset():
+        # with bpm and offset given, the converter only computes the onset envelope and detects notes
+        state["converter"] = MapConversion(state["y"], bpm=bpm, offset=0, sr=state["sr"])
+
+    def tempo():
+        drop_features(state["converter"], "dtempo", "times")
+        return state["converter"].tempos()
+
+    def offset():
+        return state["converter"].estimate_offset()
+
+    def hpss():
+        state["converter"]._harmonic = state["converter"]._percussive = None
+        return state["converter"].hpss()
+
+    def quantize():
+        state["columns"] = state["converter"].note_columns()
+
+    def serialize():
+        write_beatmap(output, state["columns"], bpm, state["converter"].timestamps[-1] * 1000)
+
+    return [("load", load), ("onset", onset), ("tempo", tempo), ("offset", offset), ("hpss", hpss),
+            ("quantize", quantize), ("serialize", serialize)]
+
+
+def ats_stages(path):
+    """Stages of the Audio Trip conversion"""
+    state = {}
+
+    def load():
+        state["data"] = load_ats(path)
+
+    def decode():
+        # notes as converted from the choreography, with ribbons longer than the editor allows
+        state["synth_json"] = decode_choreography(state["data"], 0)
+
+    def rail_split():
+        return validate_rails(state["synth_json"])
+
+    def join_rails():
+        return all_rails(state["synth_json"])
+
+    return [("ats load", load), ("ats decode", decode), ("rail split", rail_split), ("join rails", join_rails)]
+
+
+def run(args, directory):
+    """Run every case, return {case: {stage: {"seconds": ..., "peak_mb": ...}}}"""
+    cases = {}
+    for kind in ["clicks", "tones"]:
+        for seconds in args.seconds:
+            name = f"{kind} {seconds:g}s {args.bpm:g}bpm"
+            path = write_audio(Path(directory) / f"{kind}_{seconds:g}.wav", kind=kind, bpm=args.bpm, seconds=seconds)
+            cases[name] = audio_stages(path, args.bpm, Path(directory) / "beatmap.json")
+    for n_events in args.events:
+        path = write_ats(Path(directory) / f"{n_events}.ats", n_events=n_events, n_choreos=1)
+        cases[f"ats {n_events} events"] = ats_stages(path)
+
+    results = {}
+    for name, stages in cases.items():
+        results[name] = {}
+        for stage, f in stages:
+            _, seconds, peak = measure(f, args.repeat)
+            results[name][stage] = {"seconds": seconds, "peak_mb": peak}
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Print each stage next to its baseline, return the number of regressions"""
+    regressions = 0
+    print(f"{'case':<26} {'stage':<12} {'seconds':>9} {'baseline':>9} {'ratio':>6} {'peak MB':>9} {'baseline':>9} "
+          f"{'ratio':>6}")
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(name, {}).get(stage)
+            if reference is None:
+                print(f"{name:<26} {stage:<12} {result['seconds']:>9.3f} {'-':>9} {'-':>6} "
+                      f"{result['peak_mb']:>9.1f} {'-':>9} {'-':>6}")
+                continue
+            time_ratio = result["seconds"] / max(reference["seconds"], 1e-9)
+            memory_ratio = result["peak_mb"] / max(reference["peak_mb"], 1e-9)
+            flag = ""
+            slower = time_ratio > tolerance and result["seconds"] > min_seconds
+            if slower or memory_ratio > tolerance:
+                regressions += 1
+                flag = "  REGRESSION"
+            print(f"{name:<26} {stage:<12} {result['seconds']:>9.3f} {reference['seconds']:>9.3f} "
+                  f"{time_ratio:>6.2f} {result['peak_mb']:>9.1f} {reference['peak_mb']:>9.1f} "
+                  f"{memory_ratio:>6.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, nargs="+", default=[30, 120], help="lengths of the audio cases")
+    parser.add_argument("--bpm", type=float, default=120)
+    parser.add_argument("--events", type=int, nargs="+", default=[5000, 50000], help="sizes of the .ats cases")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare against")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="largest allowed ratio to the baseline for time and peak memory")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="stages faster than this are too noisy to count as slower")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = run(args, directory)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        if stored["environment"]["versions"] != library_versions():
+            print(f"Baseline was recorded with {stored['environment']['versions']}")
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+
+    if args.save_baseline is not None:
+        environment = {"python": platform.python_version(), "machine": platform.machine(),
+                       "versions": library_versions()}
+        with open(args.save_baseline, "w") as f:
+            json.dump({"environment": environment, "results": results}, f, indent=2)
+
+    if regressions > 0:
+        print(f"{regressions} stages regressed by more than {args.tolerance:g}x")
+    sys.exit(1 if regressions > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Compare the available JSON backends on synthetic Audio Trip files and the converted Synth Riders maps.
+
+    python benchmarks/bench_serialization.py --events 2000 10000 50000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from synth_auto_map import serialization
+from synth_auto_map.audio_trip_conversion import ats_to_synth
+
+from synthetic import write_ats
+
+
+def best_time(f, repeat):
+    """Fastest of several runs, in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[2000, 10000, 50000])
+    parser.add_argument("--precision", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'events':>7} {'backend':>8} {'load .ats (s)':>14} {'dump map (s)':>13} {'map size (kB)':>14} "
+          f"{f'rounded to {args.precision} (kB)':>18}")
+    with tempfile.TemporaryDirectory() as directory:
+        for n_events in args.events:
+            path = write_ats(Path(directory) / f"{n_events}.ats", n_events=n_events, n_choreos=1)
+            synth_json = ats_to_synth(path)
+            for backend in serialization.BACKENDS:
+                load_time = best_time(lambda: serialization.load(path, backend=backend), args.repeat)
+                dump_time = best_time(lambda: serialization.dumps(synth_json, backend=backend), args.repeat)
+                size = len(serialization.dumps(synth_json, backend=backend)) / 1000
+                rounded = len(serialization.dumps(synth_json, precision=args.precision, backend=backend)) / 1000
+                print(f"{n_events:>7} {backend:>8} {load_time:>14.3f} {dump_time:>13.3f} {size:>14.0f} {rounded:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
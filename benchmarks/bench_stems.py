@@ -0,0 +1,81 @@
+"""Compare serial and process pool stem analysis for 2, 4 and 5 stem splits, and onset envelopes of stacked stems
+against one stem at a time.
+
+Stems are synthetic click tracks, so this runs offline without Spleeter. The analysis gets the waveforms with their
+sampling rate, like SplitAudio passes its separated stems.
+
+    python benchmarks/bench_stems.py --seconds 120 --workers 4
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+
+from synth_auto_map.beat_finder import convert_stems
+from synth_auto_map.streaming import stacked_onset_strength
+
+STEM_NAMES = {2: ["accompaniment", "vocals"],
+              4: ["drums", "bass", "other", "vocals"],
+              5: ["drums", "bass", "piano", "other", "vocals"]}
+
+
+def make_stems(split, seconds, sr=22050):
+    """One click track per stem, each at a slightly different tempo"""
+    tracks = {}
+    for n, name in enumerate(STEM_NAMES[split]):
+        bpm = 100 + 10 * n
+        tracks[name] = librosa.clicks(times=np.arange(0, seconds, 60 / bpm), sr=sr,
+                                      length=int(seconds * sr)).astype(np.float32)
+    return tracks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    sr = 22050
+    # compile librosa's numba functions first, so the first timed run doesn't include it
+    convert_stems(make_stems(2, 5, sr), reference=STEM_NAMES[2][0], sr=sr)
+
+    print(f"{'stems':>5} {'serial (s)':>12} {'parallel (s)':>14} {'speedup':>8}")
+    for split in STEM_NAMES:
+        tracks = make_stems(split, args.seconds, sr)
+        reference = STEM_NAMES[split][0]
+
+        start = time.perf_counter()
+        serial, _, _ = convert_stems(tracks, reference=reference, workers=1, sr=sr)
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parallel, _, _ = convert_stems(tracks, reference=reference, workers=args.workers, sr=sr)
+        parallel_time = time.perf_counter() - start
+
+        for key in serial:
+            assert np.array_equal(serial[key].timestamps, parallel[key].timestamps)
+
+        print(f"{split:>5} {serial_time:>12.2f} {parallel_time:>14.2f} {serial_time / parallel_time:>8.2f}")
+
+    print(f"\n{'stems':>5} {'per stem (s)':>14} {'stacked (s)':>13} {'speedup':>8}")
+    for split in STEM_NAMES:
+        signals = np.stack(list(make_stems(split, args.seconds, sr).values()))
+
+        start = time.perf_counter()
+        separate = np.stack([librosa.onset.onset_strength(y=y, sr=sr) for y in signals])
+        separate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stacked = stacked_onset_strength(signals, sr)
+        stacked_time = time.perf_counter() - start
+
+        # single precision changes the envelopes in the last digits, the onsets must be the same
+        assert np.allclose(separate, stacked, atol=1e-4)
+        for a, b in zip(separate, stacked):
+            assert np.array_equal(librosa.onset.onset_detect(onset_envelope=a, sr=sr),
+                                  librosa.onset.onset_detect(onset_envelope=b, sr=sr))
+        print(f"{split:>5} {separate_time:>14.2f} {stacked_time:>13.2f} {separate_time / stacked_time:>8.2f}")
+
+if __name__ == "__main__":
+    main()
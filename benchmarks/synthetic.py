@@ -0,0 +1,97 @@
+"""Synthetic inputs for the benchmarks, so everything runs offline without real songs or maps."""
+import json
+
+import numpy as np
+import soundfile as sf
+
+
+def make_ats(n_events=5000, n_choreos=3, bpm=128.0, ribbon_fraction=0.3, long_ribbon_fraction=0.05, seed=0):
+    """
+    Generate an Audio Trip .ats document with random gems and ribbons
+
+    :param n_events: number of events in the largest choreography, the others are smaller
+    :param n_choreos: number of choreographies
+    :param bpm: average bpm
+    :param ribbon_fraction: fraction of events that are ribbons
+    :param long_ribbon_fraction: fraction of ribbons lasting 12 to 40 seconds, longer than a rail can be in the editor
+    :param seed: random seed
+    :return: dict ready to be written as json
+    """
+    rng = np.random.default_rng(seed)
+    choreos = []
+    for c in range(n_choreos):
+        events = []
+        beat = 0
+        for _ in range(n_events * (c + 1) // n_choreos):
+            beat += int(rng.integers(0, 2))
+            denominator = int(rng.choice([1, 2, 4, 8]))
+            is_ribbon = rng.random() < ribbon_fraction
+            event = {"time": {"beat": beat, "numerator": int(rng.integers(0, denominator)), "denominator": denominator},
+                     "type": int(rng.choice([3, 4] if is_ribbon else [1, 2])),
+                     "position": {"x": float(rng.uniform(-1, 1)), "y": float(rng.uniform(0, 2)), "z": 0.0}}
+            if is_ribbon:
+                event["beatDivision"] = int(rng.choice([2, 4, 8]))
+                if rng.random() < long_ribbon_fraction:
+                    n_nodes = int(np.ceil(rng.uniform(12, 40) * bpm / 60 * event["beatDivision"]))
+                else:
+                    n_nodes = int(rng.integers(2, 40))
+                offsets = rng.uniform(-0.5, 0.5, (n_nodes, 2))
+                event["subPositions"] = [{"x": 0.0, "y": 0.0, "z": 0.0}] + \
+                    [{"x": float(x), "y": float(y), "z": 0.0} for x, y in offsets]
+                beat += len(offsets) // event["beatDivision"]
+            events.append(event)
+        choreos.append({"header": {"name": f"Choreo {c}"}, "data": {"events": events}})
+
+    return {"metadata": {"avgBPM": bpm, "songEndTimeInSeconds": beat * 60 / bpm + 10,
+                         "tempoSections": [{"startTimeInSeconds": 0.5, "doesStartNewMeasure": True}]},
+            "choreographies": {"list": choreos}}
+
+
+def write_ats(path, **kwargs):
+    """Write a synthetic .ats file, see make_ats() for arguments"""
+    with open(path, "w") as f:
+        json.dump(make_ats(**kwargs), f)
+    return path
+
+
+def make_audio(kind="clicks", bpm=120.0, seconds=60.0, offset=0.25, sr=22050, seed=0):
+    """
+    Generate a mono test signal with one event per beat
+
+    :param kind: "clicks" for librosa click track style impulses, "tones" for decaying tone bursts at random pitches
+    :param bpm: beats per minute
+    :param seconds: length of the signal
+    :param offset: time of the first beat in seconds
+    :param sr: sampling rate
+    :param seed: random seed for the tone pitches
+    :return: float32 numpy array
+    """
+    n_samples = int(seconds * sr)
+    beats = np.arange(offset, seconds, 60 / bpm)
+    starts = np.round(beats * sr).astype(int)
+    y = np.zeros(n_samples, dtype=np.float32)
+
+    if kind == "clicks":
+        # 1 kHz click with an exponential decay, as in librosa.clicks
+        length = int(0.1 * sr)
+        t = np.arange(length) / sr
+        bursts = np.tile(np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 200), (beats.size, 1))
+    elif kind == "tones":
+        rng = np.random.default_rng(seed)
+        length = int(min(0.25, 30 / bpm) * sr)
+        t = np.arange(length) / sr
+        frequencies = 110 * 2 ** (rng.integers(0, 36, beats.size) / 12)
+        bursts = 0.5 * np.sin(2 * np.pi * frequencies[:, None] * t) * np.exp(-t * 12)
+    else:
+        raise ValueError(f"Unknown synthetic audio {kind}, options are clicks or tones")
+
+    for start, burst in zip(starts, bursts):
+        end = min(start + length, n_samples)
+        y[start:end] += burst[:end - start]
+    return y
+
+
+def write_audio(path, sr=22050, **kwargs):
+    """Write a synthetic audio file, see make_audio() for arguments"""
+    sf.write(path, make_audio(sr=sr, **kwargs), sr)
+    return path
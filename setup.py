@@ -11,5 +11,6 @@ setuptools.setup(
     description='Automation tools for Synth Riders beatmapping',
     package_dir={'': 'src'},
     python_requires='>=3.9',
-    install_requires=['librosa', 'spleeter', 'numpy', 'scipy', 'pandas', 'matplotlib', 'synth-mapping-helper', 'mplcyberpunk']
+    install_requires=['librosa', 'soundfile', 'spleeter', 'numpy', 'scipy', 'pandas', 'matplotlib', 'synth-mapping-helper', 'mplcyberpunk'],
+    extras_require={'fast': ['orjson']}
 )
\ No newline at end of file
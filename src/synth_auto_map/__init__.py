@@ -1,2 +1,10 @@
-from . import audio_trip_conversion
-from . import beat_finder
\ No newline at end of file
+import importlib
+
+# submodules are imported on first access, so importing one of them doesn't pull in the dependencies of the others
+__all__ = ["audio_trip_conversion", "beat_finder", "cache", "instrumentation", "jobs", "serialization", "streaming"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,13 @@
-from bisect import bisect
-import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import argparse
 import math
+import re
+import time
 import numpy as np
 
+from . import serialization
+
 '''Functions for conversion from Audio Trip .ats files to Synth Riders compatible JSON.
     This will convert gems and ribbons ONLY.
 
@@ -68,51 +73,91 @@ def rail_format(rail_array, type):
 
 
 def all_rails(synth_json):
-    """Connect all notes into rails"""
+    """Connect all notes of each type into one rail in time order, split into rails of valid length"""
 
     notes = synth_json['notes']
-    position_types = {k: {n['Type']: {'Position': n['Position'], 'Segments': n['Segments']} for n in notes[k]} for k in
-                      notes.keys()}
     note_types = [0, 1, 2, 3]
-    # for the new rail associated with each note type
-    new_rails = {}
-    # position keys for each note type
-    first_positions = {}
-
-    for type in note_types:
-        # get keys for note type
-        positions = [k for k in position_types.keys() if type in position_types[k].keys()]
-        # get a list of all positions for each note type
-        position_list = [[position_types[k][type]['Position']] + position_types[k][type]['Segments']
-                         if position_types[k][type]['Segments'] is not None else [position_types[k][type]['Position']]
-                         for k in positions]
-
-        position_list = [n for p in position_list for n in p]
-        if len(position_list) > 0:
-            new_rails[type] = {'Position': position_list[0], 'Segments': None, 'Type': type}
-            first_positions[type] = positions[0]
-
-            if len(position_list) > 1:
-                new_rails[type]['Segments'] = position_list[1:]
-
-    # The note types we actually have
-    final_types = list(new_rails.keys())
+    increment = synth_json['BPM'] * 64 / 60 / 20
+
+    # count the nodes of each type so they can be collected into preallocated arrays
+    counts = dict.fromkeys(note_types, 0)
+    for position_notes in notes.values():
+        for note in position_notes:
+            counts[note['Type']] += 1 + (len(note['Segments']) if note['Segments'] is not None else 0)
+
+    nodes = {t: np.empty((counts[t], 3)) for t in note_types}
+    # index of the position key each node came from
+    node_keys = {t: np.empty(counts[t], dtype=int) for t in note_types}
+    filled = dict.fromkeys(note_types, 0)
+    positions = list(notes.keys())
+    for k, position in enumerate(positions):
+        for note in notes[position]:
+            t = note['Type']
+            start = filled[t]
+            end = start + 1
+            nodes[t][start] = note['Position']
+            if note['Segments'] is not None and len(note['Segments']) > 0:
+                end += len(note['Segments'])
+                nodes[t][start + 1:end] = note['Segments']
+            node_keys[t][start:end] = k
+            filled[t] = end
+
     new_json = synth_json.copy()
+    new_json['notes'] = {}
 
-    # the first rail
-    new_json['notes'] = {first_positions[final_types[0]]: [new_rails[final_types[0]]]}
+    for t in note_types:
+        if counts[t] == 0:
+            continue
+        order = np.argsort(nodes[t][:, 2], kind="stable")
+        rails = split_rail(nodes[t][order])
+        # the first rail starts at the position of the earliest note, the others at the step of their first node
+        steps = [positions[node_keys[t][order[0]]]] + [round(rail[0, 2] * increment) for rail in rails[1:]]
+        for step, rail in zip(steps, rails):
+            rail = rail.tolist()
+            new_rail = rail_format(rail, t) if len(rail) > 1 else {'Position': rail[0], 'Segments': None, 'Type': t}
+            new_json['notes'].setdefault(step, []).append(new_rail)
+
+    return new_json
 
-    # if we actually have more rails...
-    if len(final_types) > 1:
-        for type in final_types[1:]:
-            p = first_positions[type]
-            if p in new_json['notes'].keys():
-                new_json['notes'][p].append(new_rails[type])
-            else:
-                new_json['notes'][p].append(new_rails[type])
 
-    # validate rails and split
-    return validate_rails(new_json)
+def split_rail(nodes, max_length=200, split_length=205):
+    """
+    Split a rail into consecutive sub-rails no longer than max_length (in 20 * seconds). Split points are interpolated
+    on the rail, and each one is both the last node of a sub-rail and the first node of the next.
+
+    :param nodes: (N, 3) numpy array of x, y, z nodes in time order, including the starting position
+    :param max_length: rails at least this long are split
+    :param split_length: target length of the sub-rails, slightly larger than max_length for safety
+    :return: list of (M, 3) numpy arrays
+    """
+    times = nodes[:, 2]
+    length = times[-1] - times[0]
+    if length < max_length:
+        return [nodes]
+
+    num_splits = math.ceil(length / split_length)
+    split_times = np.linspace(times[0], times[-1], num=num_splits + 2)[1:-1]
+
+    # node after each split, all found at once
+    after = np.searchsorted(times, split_times, side="right")
+    before_nodes = nodes[after - 1]
+    after_nodes = nodes[after]
+    split_xy = before_nodes[:, :2] + (after_nodes[:, :2] - before_nodes[:, :2]) * \
+        (split_times - before_nodes[:, 2])[:, None] / (after_nodes[:, 2] - before_nodes[:, 2])[:, None]
+    split_nodes = np.column_stack([split_xy, split_times])
+
+    # splits that share a segment start from the previous split point, so they round exactly as they would if the
+    # points were inserted one at a time
+    for n in np.flatnonzero(after[1:] == after[:-1]) + 1:
+        split_nodes[n, :2] = interpolate_at_time(split_nodes[n - 1], nodes[after[n]], split_times[n])[:2]
+
+    all_nodes = np.insert(nodes, after, split_nodes, axis=0)
+    # location of each split point once inserted
+    split_indices = after + np.arange(split_times.size)
+
+    starts = np.r_[0, split_indices]
+    ends = np.r_[split_indices, all_nodes.shape[0] - 1] + 1
+    return [all_nodes[start:end] for start, end in zip(starts, ends)]
 
 
 def validate_rails(synth_json):
@@ -127,80 +172,122 @@ def validate_rails(synth_json):
         if position not in new_json['notes']:
             new_json['notes'][position] = []
         for type in synth_json['notes'][position]:
-            # single notes
-            if type['Segments'] is None:
+            # single notes and short rails
+            if type['Segments'] is None or len(type['Segments']) == 0 or \
+                    type['Segments'][-1][2] - type['Position'][2] < 200:
                 new_json['notes'][position].append(type)
-            # rails
+            # long rails
             else:
-                length = type['Segments'][-1][2] - type['Position'][2]
-                if length < 200:
-                    # short rail
-                    new_json['notes'][position].append(type)
-                else:
-                    # long rail
-                    # get split time positions, use slightly larger value for safety
-                    num_splits = math.ceil(length / 205)
-                    split_times = np.linspace(type['Position'][2], type['Segments'][-1][2], num=num_splits + 2)[1:-1]
-                    # Find insertion points: https://docs.python.org/3/library/bisect.html#bisect.bisect
-                    segment_times = [n[2] for n in type['Segments']]
-                    insertion_indices = np.array([bisect(segment_times, s) + 1 for s in split_times])
-
-                    split_indices = []
-                    old_segments = [type['Position']] + type['Segments']
-
-                    for n in range(split_times.size):
-                        idx = insertion_indices[n]
-                        split_xyz = interpolate_at_time(np.array(old_segments[idx - 1]), np.array(old_segments[idx]),
-                                                        split_times[n])
-                        # insert the new point
-                        old_segments.insert(idx, split_xyz)
-                        # record the split location in the list
-                        split_indices.append(idx)
-                        # add 1 to remaining insertion indices
-                        insertion_indices[n + 1:] += 1
-
-                    # Now, actually split the thing
-                    # The first one is pretty straightforward
-                    new_json['notes'][position].append(rail_format(old_segments[:split_indices[0] + 1], type["Type"]))
-                    # The others require some checks
-                    for n in range(len(split_indices) - 1):
-                        new_rail = rail_format(old_segments[split_indices[n]: split_indices[n + 1] + 1], type["Type"])
-                        step = round(old_segments[split_indices[n]][2] * increment)
-                        if step not in new_json['notes']:
-                            new_json['notes'][step] = [new_rail]
-                        else:
-                            new_json['notes'][step].append(new_rail)
-                    # and the last one...
-                    last_rail = rail_format(old_segments[split_indices[-1]:], type["Type"])
-                    step = round(old_segments[split_indices[-1]][2] * increment)
-                    if step not in new_json['notes']:
-                        new_json['notes'][step] = [last_rail]
-                    else:
-                        new_json['notes'][step].append(last_rail)
+                rails = split_rail(np.array([type['Position']] + type['Segments'], dtype=float))
+                # The first one stays in place, the others are placed at the step of their first node
+                new_json['notes'][position].append(rail_format(rails[0].tolist(), type["Type"]))
+                for rail in rails[1:]:
+                    step = round(rail[0, 2] * increment)
+                    new_json['notes'].setdefault(step, []).append(rail_format(rail.tolist(), type["Type"]))
 
     return new_json
 
 
-def ats_to_synth(path, choreo_name=None, convert_to_rails=False):
-    '''
-    Import an audio trip ats file to synth riders (basic gems/notes and ribbons/rails only)
+def decode_events(events, bpm, offset):
+    """
+    Convert Audio Trip gems (types 1, 2) and ribbons (types 3, 4) to Synth Riders timing and coordinates in bulk.
+    Other event types are dropped.
 
-    :path: path to .ats file containing Audio Trip choreography
-    :choreo_number: index (starting at 0) of Audio Trip choreography to use, if known
-    :convert_to_rails: boolean, set to True to join all notes into rails
-    :return: dict of things ready to be converted to Synth Riders json
-    '''
-    f = open(path)
-    data = json.load(f)
+    :param events: list of choreography events from an .ats file
+    :param bpm: average bpm of the song
+    :param offset: offset in seconds
+    :return: dict with "position" (1/64 increments) and "type" numpy arrays, "x", "y", "z" lists of floats,
+            and "segments", a list with the remaining [x, y, z] ribbon nodes or None for each event
+    """
+    increment = bpm * 64 / 60
+    offset_inc = round(offset * increment)
+
+    events = [e for e in events if e['type'] in (1, 2, 3, 4)]
+    columns = np.array([[e['time']['beat'], e['time']['numerator'], e['time']['denominator'],
+                         e['position']['x'], e['position']['y'], e['type']] for e in events], dtype=float).reshape(-1, 6)
+    beat, numerator, denominator, at_x, at_y, types = columns.T
+    types = types.astype(int)
+
+    # SR position format: count of 1/64th increments
+    position = np.round((beat + numerator / denominator) * 64).astype(int) + offset_inc
+    # SR time format: seconds * 20
+    z = 20 * position / increment + offset * 20
+    x, y = xy_ats_to_synth(at_x, at_y)
+
+    # ribbons: flatten every node after the first
+    ribbons = np.flatnonzero(types >= 3)
+    nodes = [events[r]['subPositions'][1:] for r in ribbons]
+    counts = np.array([len(n) for n in nodes], dtype=int)
+    node_xy = np.array([[node['x'], node['y']] for n in nodes for node in n], dtype=float).reshape(-1, 2)
+
+    # time step between nodes in 20 * seconds
+    # see var length_beatDivision for calculation:
+    # https://github.com/Blogshot/trip-sitter/blob/master/SR_to_AT/conversion_elements.js
+    step = 60 * 20 / (bpm * np.array([events[r]['beatDivision'] for r in ribbons], dtype=float))
+    node_x, node_y = xy_ats_to_synth(np.repeat(at_x[ribbons], counts) + node_xy[:, 0],
+                                     np.repeat(at_y[ribbons], counts) + node_xy[:, 1])
+
+    # each node is one step after the previous one. The steps are added one at a time like the editor does, so the
+    # rounding matches and rails are split at the same nodes. Ribbons with the same number of nodes are summed
+    # together as the rows of a matrix.
+    node_z = np.empty(counts.sum())
+    starts = np.cumsum(counts) - counts
+    for count in np.unique(counts[counts > 0]).tolist():
+        rows = np.flatnonzero(counts == count)
+        steps = np.repeat(step[rows, None], count + 1, axis=1)
+        steps[:, 0] = z[ribbons[rows]]
+        node_z[starts[rows, None] + np.arange(count)] = np.cumsum(steps, axis=1)[:, 1:]
+
+    # convert all nodes at once, then slice out each ribbon
+    all_nodes = np.column_stack([node_x, node_y, node_z]).tolist()
+    ends = np.cumsum(counts).tolist()
+    segments = [None] * len(events)
+    for r, start, end in zip(ribbons.tolist(), [0] + ends[:-1], ends):
+        segments[r] = all_nodes[start:end]
+
+    return {"position": position, "type": types, "x": x.tolist(), "y": y.tolist(), "z": z.tolist(),
+            "segments": segments}
+
+
+def load_ats(path):
+    """Read an Audio Trip .ats file"""
+    return serialization.load(path)
+
+
+def select_choreography(data, choreo_name=None):
+    """
+    Find a choreography by name
+
+    :param data: parsed .ats file
+    :param choreo_name: name of the choreography, if not given or not found the one with the most events is used
+    :return: index of the choreography
+    """
+    choreos = data['choreographies']['list']
+    if isinstance(choreo_name, str):
+        # find the index of the choreography name
+        name_list = [c['header']['name'] for c in choreos]
+        if choreo_name in name_list:
+            return name_list.index(choreo_name)
+
+    # if the specific index wasn't specified, or wasn't valid, use the one with the most data
+    choreo_size = [len(c['data']['events']) for c in choreos]
+    return choreo_size.index(max(choreo_size))
+
+
+def decode_choreography(data, choreo_num):
+    """
+    Notes of one choreography of a parsed .ats file, before rails are checked or joined
 
+    :param data: parsed .ats file
+    :param choreo_num: index of the choreography
+    :return: Synth Riders json dict, rails may still be longer than the editor allows
+    """
     bpm = data['metadata']['avgBPM']
-    increment = bpm * 64 / 60
 
-    # get time and increment offsets
+    # get time offset
     offset_list = [section['startTimeInSeconds'] for section in data['metadata']['tempoSections']
                    if section['doesStartNewMeasure']]
     offset = offset_list[0]
-    offset_inc = round(offset * increment)
 
     synth_json = {
         "BPM": bpm,
@@ -224,67 +311,145 @@ def ats_to_synth(path, choreo_name=None, convert_to_rails=False):
             left notes type 1'''
     type_map = {2: 0, 1: 1, 3: 1, 4: 0}
 
-    # extract the choreography map to use
-    choreos = data['choreographies']['list']
-    if isinstance(choreo_name, str):
-        # find the index of the choreography name
-        name_list = [c['header']['name'] for c in choreos]
-        if choreo_name in name_list:
-            choreo_num = name_list.index(choreo_name)
-        else:
-            choreo_size = [len(c['data']['events']) for c in choreos]
-            choreo_num = choreo_size.index(max(choreo_size))
-    else:
-        # if the specific index wasn't specified, or wasn't valid, use the one with the most data
-        choreo_size = [len(c['data']['events']) for c in choreos]
-        choreo_num = choreo_size.index(max(choreo_size))
-
-    choreo = choreos[choreo_num]['data']['events']
-
-    for gem in choreo:
-        b = gem['time']['beat']
-        n = gem['time']['numerator']
-        d = gem['time']['denominator']
-
-        # SR position format: count of 1/64th increments
-        s_position = round((b + n / d) * 64) + offset_inc
-        # SR time format: seconds * 20
-        z_val = 20 * s_position / increment + offset * 20
-        x, y = xy_ats_to_synth(gem['position']['x'], gem['position']['y'])
-
-        type = gem['type']
-        if type == 3 or type == 4:
-            # it's a rail!
-            new_note = {"Position": [x, y, z_val], "Segments": [], "Type": type_map[type]}
-
-            # time step between nodes in 20 * seconds
-            # see var length_beatDivision for calculation:
-            # https://github.com/Blogshot/trip-sitter/blob/master/SR_to_AT/conversion_elements.js
-            step = 60 * 20 / (bpm * gem['beatDivision'])
-
-            # now append all of those segments
-            for node in gem['subPositions'][1:]:
-                x_offset, y_offset = xy_ats_to_synth(gem['position']['x'] + node['x'], gem['position']['y'] + node['y'])
-                z_val += step
-                new_note["Segments"].append([x_offset, y_offset, z_val])
-
-            # Add to an existing position if one already exists
-            if s_position in synth_json['notes']:
-                synth_json['notes'][s_position].append(new_note)
-            else:
-                synth_json['notes'][s_position] = [new_note]
+    choreo = data['choreographies']['list'][choreo_num]['data']['events']
 
-        elif type == 1 or type == 2:
-            # it's a note!
-            new_note = {"Position": [x, y, z_val], "Segments": None, "Type": type_map[type]}
+    events = decode_events(choreo, bpm, offset)
+
+    types = events["type"].tolist()
+    for n, s_position in enumerate(events["position"].tolist()):
+        new_note = {"Position": [events["x"][n], events["y"][n], events["z"][n]], "Segments": events["segments"][n],
+                    "Type": type_map[types[n]]}
+        # Add to an existing position if one already exists
+        synth_json['notes'].setdefault(s_position, []).append(new_note)
+
+    return synth_json
 
-            # Add to an existing position if one already exists
-            if s_position in synth_json['notes']:
-                synth_json['notes'][s_position].append(new_note)
-            else:
-                synth_json['notes'][s_position] = [new_note]
 
+def convert_choreography(data, choreo_num, convert_to_rails=False):
+    """
+    Convert one choreography of a parsed .ats file
+
+    :param data: parsed .ats file
+    :param choreo_num: index of the choreography
+    :param convert_to_rails: boolean, set to True to join all notes into rails
+    :return: dict of things ready to be converted to Synth Riders json
+    """
+    synth_json = decode_choreography(data, choreo_num)
     if convert_to_rails:
         return all_rails(synth_json)
     else:
         return validate_rails(synth_json)
+
+
+def ats_to_synth(path, choreo_name=None, convert_to_rails=False):
+    '''
+    Import an audio trip ats file to synth riders (basic gems/notes and ribbons/rails only)
+
+    :path: path to .ats file containing Audio Trip choreography
+    :choreo_name: name of Audio Trip choreography to use, if known
+    :convert_to_rails: boolean, set to True to join all notes into rails
+    :return: dict of things ready to be converted to Synth Riders json
+    '''
+    data = load_ats(path)
+    return convert_choreography(data, select_choreography(data, choreo_name), convert_to_rails=convert_to_rails)
+
+
+def ats_to_synth_all(path, choreo_names=None, convert_to_rails=False):
+    '''
+    Convert several choreographies from one .ats file, parsing it only once
+
+    :param path: path to .ats file
+    :param choreo_names: list of choreography names to convert, all of them if None
+    :param convert_to_rails: boolean, set to True to join all notes into rails
+    :return: dict of choreography name: Synth Riders json dict. Repeated names get the index of the choreography
+            appended, e.g. "Expert_3".
+    '''
+    data = load_ats(path)
+    names = [c['header']['name'] for c in data['choreographies']['list']]
+    converted = {}
+    for n, name in enumerate(names):
+        if choreo_names is None or name in choreo_names:
+            key = name if name not in converted else f"{name}_{n}"
+            converted[key] = convert_choreography(data, n, convert_to_rails=convert_to_rails)
+    return converted
+
+
+def _convert_ats_file(path, output_dir, choreo_names, convert_to_rails, precision):
+    """Worker task for convert_ats_files: convert and write every selected choreography of one file"""
+    start = time.perf_counter()
+    converted = ats_to_synth_all(path, choreo_names=choreo_names, convert_to_rails=convert_to_rails)
+    outputs = []
+    safe_names = set()
+    for n, (name, synth_json) in enumerate(converted.items()):
+        # keep choreography names usable as file names, without overwriting one that sanitizes to the same name
+        safe_name = re.sub(r"[^\w\-]+", "_", name)
+        if safe_name in safe_names:
+            safe_name = f"{safe_name}_{n}"
+        safe_names.add(safe_name)
+        output_path = Path(output_dir) / f"{Path(path).stem}_{safe_name}.json"
+        serialization.dump(synth_json, output_path, precision=precision)
+        outputs.append(str(output_path))
+    return outputs, time.perf_counter() - start
+
+
+def convert_ats_files(paths, output_dir=".", choreo_names=None, convert_to_rails=False, workers=None,
+                      precision=None):
+    '''
+    Convert every choreography (or a selection) of many .ats files into Synth Riders json files, spreading the files
+    across a process pool. Each output is named <ats file name>_<choreography name>.json.
+    Timing for each file and overall throughput are printed as files complete. Files that fail to convert are
+    reported and skipped, the others are still converted.
+
+    :param paths: list of paths to .ats files
+    :param output_dir: directory for the json files, created if needed
+    :param choreo_names: list of choreography names to convert, all of them if None
+    :param convert_to_rails: boolean, set to True to join all notes into rails
+    :param workers: number of processes, defaults to the number of CPUs
+    :param precision: number of decimals to round coordinates to, full precision if None
+    :return: dict of .ats path: list of json files written, for the files that were converted
+    '''
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    results = {}
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_convert_ats_file, path, output_dir, choreo_names, convert_to_rails,
+                                   precision): path
+                   for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                outputs, seconds = future.result()
+            except Exception as error:
+                failed += 1
+                print(f"{path}: failed, {type(error).__name__}: {error}")
+                continue
+            results[path] = outputs
+            print(f"{path}: {len(outputs)} choreographies in {seconds:.2f} s")
+
+    elapsed = time.perf_counter() - start
+    total = sum(len(outputs) for outputs in results.values())
+    print(f"Converted {total} choreographies from {len(results)} files in {elapsed:.2f} s "
+          f"({len(results) / elapsed:.2f} files/s, {total / elapsed:.2f} choreographies/s)")
+    if failed:
+        print(f"{failed} files could not be converted")
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Convert Audio Trip .ats choreographies to Synth Riders json")
+    parser.add_argument("paths", nargs="+", help=".ats files to convert")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory for the json files")
+    parser.add_argument("-c", "--choreo", action="append", dest="choreo_names",
+                        help="name of a choreography to convert, can be repeated. Converts all if not given.")
+    parser.add_argument("-r", "--rails", action="store_true", help="join all notes into rails")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("-p", "--precision", type=int, default=None, help="decimals to round coordinates to")
+    options = parser.parse_args(args)
+
+    convert_ats_files(options.paths, output_dir=options.output_dir, choreo_names=options.choreo_names,
+                      convert_to_rails=options.rails, workers=options.workers, precision=options.precision)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,21 @@
 import librosa
-from spleeter.separator import Separator
 from pathlib import Path
+from dataclasses import dataclass, field
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from scipy import stats as st
-import pandas as pd
-import json
-import matplotlib.pyplot as plt
-# Thematic! (This is just for ambiance in plots)
-import mplcyberpunk
+import soundfile as sf
+
+# Spleeter (and TensorFlow), scipy.stats, pandas and the plotting libraries are slow to import and only needed by
+# some features, so they are imported where they are used
+
+from .streaming import stacked_onset_strength, stream_onset_strength
+from . import instrumentation, serialization
 
 
 class MapConversion:
-    def __init__(self, filename, bpm=None, offset=None, decomposition=None):
+    def __init__(self, filename, bpm=None, offset=None, decomposition=None, streaming=False, block_length=1024,
+                 sr=None, cache=None, onset_env=None):
         '''
         Initialize an object to extract and manipulate waveform data from an audio file. Everything is calculated in
         seconds, so processing doesn't depend on a stable bpm.
@@ -22,12 +26,60 @@ class MapConversion:
         Identifying time values corresponding to beats stored in .timestamps
         Exporting a JSON file with notes positioned on the identified beats with generate_beatmap()
 
-        :param filename: path to audio file
+        :param filename: path to audio file, or a mono waveform as a numpy array if it is already loaded
         :param bpm: beats per minute, if known, will be detected otherwise
-        :param offset: offset in seconds
+        :param offset: offset in seconds, will be detected from the beat grid otherwise
         :param decomposition: defaults to using the standard file, options are "harmonic" or "percussive"
+        :param streaming: if True, analyse the file block by block at its native sampling rate instead of loading it.
+                        Use this for very long tracks. Decomposition is not available in this mode.
+        :param block_length: number of frames per block when streaming
+        :param sr: sampling rate of the waveform, required if filename is an array. Arrays are used as is.
+        :param cache: optional AnalysisCache, decoded audio, decompositions and analysis features are stored there and
+                    reused by later runs on the same audio
+        :param onset_env: onset envelope of the waveform if it's already known, e.g. from stacked_onset_strength().
+                        Only used with array input.
         '''
-        self.y, self.samplingrate = librosa.load(filename)
+        self.hop_length = 512
+        self.cache = cache
+        # timing records of each analysis stage, filled while instrumentation is enabled
+        self.stages = []
+
+        # onset envelopes, tempo curves etc. for each signal, see feature()
+        self._analysis_cache = {}
+        # hop length and onset envelope of the standard signal when it was streamed or given, kept out of
+        # _analysis_cache so clear_analysis() doesn't lose it
+        self._onset_env = None
+        self._stream = None
+
+        if streaming:
+            if decomposition is not None:
+                raise ValueError("decomposition is not available when streaming")
+            self.y = None
+            info = sf.info(filename)
+            self.samplingrate, self.duration = info.samplerate, info.frames / info.samplerate
+            if cache is not None:
+                self._content_hash = cache.file_hash(filename)
+            self._stream = (filename, block_length)
+            with instrumentation.span("stream onset_env", self.stages):
+                self._onset_env = (self.hop_length, self._cached("features", "onset_env", self._stream_onset_env,
+                                                                  decomp=None))
+        elif isinstance(filename, np.ndarray):
+            if sr is None:
+                raise ValueError("sr is required when passing a waveform array")
+            self.y, self.samplingrate = filename, sr
+            if cache is not None:
+                self._content_hash = cache.array_hash(self.y)
+            self.duration = librosa.get_duration(y=self.y, sr=self.samplingrate)
+            if onset_env is not None:
+                self._onset_env = (self.hop_length, self._cached("features", "onset_env", lambda: onset_env,
+                                                                  decomp=None))
+        else:
+            self.samplingrate = 22050  # librosa's default
+            if cache is not None:
+                self._content_hash = cache.file_hash(filename)
+            with instrumentation.span("load", self.stages):
+                self.y = self._cached("load", "y", lambda: librosa.load(filename, sr=self.samplingrate)[0])
+            self.duration = librosa.get_duration(y=self.y, sr=self.samplingrate)
 
         if bpm is None:
             self.bpm = self.tempos()
@@ -37,26 +89,150 @@ class MapConversion:
         self.increment = self.bpm * 64 / 60  # 1/64th increments per sec
 
         if offset is None:
-            # TODO: get autodetection working
-            self.offset = 0
+            self.offset = self.estimate_offset()
         else:
             self.offset = offset
 
         self.timestamps = None
+        self.decomposition = None
+        # analysis result of the current timestamps and the array it was made from, see analysis
+        self._analysis = None
+        self._analysis_of = None
 
-        D = librosa.stft(self.y)
-        H, P = librosa.decompose.hpss(D)
-        self.harmonic = librosa.istft(H)
-        self.percussive = librosa.istft(P)
+        # harmonic/percussive components are only separated on first access, see hpss()
+        self._harmonic = None
+        self._percussive = None
 
         self.use_decomp(decomposition)
 
+    @property
+    def harmonic(self):
+        '''Harmonic component of the signal, computed on first access'''
+        if self._harmonic is None:
+            self.hpss()
+        return self._harmonic
+
+    @property
+    def percussive(self):
+        '''Percussive component of the signal, computed on first access'''
+        if self._percussive is None:
+            self.hpss()
+        return self._percussive
+
+    def hpss(self):
+        '''
+        Separate the signal into harmonic and percussive components. The STFT and both inverse transforms are only
+        run once, the results are cached for later use_decomp() calls.
+
+        :return: harmonic and percussive waveforms as numpy arrays
+        '''
+        if self.y is None:
+            raise ValueError("decomposition is not available when streaming")
+        if self._harmonic is None or self._percussive is None:
+            if self.cache is not None:
+                key = self.cache.key(self._content_hash, stage="hpss", sr=self.samplingrate)
+                self._harmonic = self.cache.get(key, "harmonic")
+                self._percussive = self.cache.get(key, "percussive")
+
+        if self._harmonic is None or self._percussive is None:
+            with instrumentation.span("hpss", self.stages):
+                D = librosa.stft(self.y)
+                H, P = librosa.decompose.hpss(D)
+                self._harmonic = librosa.istft(H)
+                self._percussive = librosa.istft(P)
+            if self.cache is not None:
+                self.cache.put(key, "harmonic", self._harmonic)
+                self.cache.put(key, "percussive", self._percussive)
+
+        return self._harmonic, self._percussive
+
+    def _cached(self, stage, name, compute, **params):
+        '''
+        Get an array from the on-disk cache if one is in use, computing and storing it if needed
+
+        :param stage: analysis stage, part of the cache key
+        :param name: name of the array
+        :param compute: function with no arguments returning the array
+        :param params: any other parameters the result depends on
+        :return: numpy array
+        '''
+        if self.cache is None:
+            return compute()
+        key = self.cache.key(self._content_hash, stage=stage, sr=self.samplingrate, hop_length=self.hop_length,
+                             **params)
+        return self.cache.get_or_compute(key, name, compute)
+
     def update_bpm(self, new_bpm):
         if new_bpm is None:
             self.bpm = self.tempos()
         else:
             self.bpm = new_bpm
-            self.increment = self.bpm * 64 / 60
+        self.increment = self.bpm * 64 / 60
+
+    def _stream_onset_env(self):
+        '''Stream the onset envelope from the file again, at the current hop length'''
+        filename, block_length = self._stream
+        return stream_onset_strength(filename, block_length=block_length, hop_length=self.hop_length)[0]
+
+    def _signal(self, decomp):
+        '''Waveform for the standard file or one of its components'''
+        if decomp == "harmonic":
+            return self.harmonic
+        elif decomp == "percussive":
+            return self.percussive
+        else:
+            return self.y
+
+    def feature(self, name, decomp=None):
+        '''
+        Shared analysis feature for a signal, computed once and reused by tempos(), tempo_breakdown() and notes().
+        Features are stored under the signal and the hop length/sampling rate used, call clear_analysis() if any of
+        them change.
+
+        :param name: "onset_env", "dtempo" (dynamic tempo), "times" (of the dtempo frames) or "onset_frames"
+        :param decomp: None for the standard file, "harmonic" or "percussive"
+        :return: numpy array
+        '''
+        key = (decomp, self.samplingrate, self.hop_length)
+        features = self._analysis_cache.setdefault(key, {})
+
+        if name == "onset_env" and name not in features and decomp is None and self._onset_env is not None \
+                and self._onset_env[0] == self.hop_length:
+            # streamed or given envelope, still valid after clear_analysis() as long as the hop length is the same
+            features[name] = self._onset_env[1]
+
+        if name not in features:
+            if name == "onset_env" and self._stream is not None:
+                compute = self._stream_onset_env
+            elif name == "onset_env":
+                compute = lambda: librosa.onset.onset_strength(y=self._signal(decomp), sr=self.samplingrate,
+                                                               hop_length=self.hop_length)
+            elif name == "dtempo":
+                compute = lambda: librosa.beat.tempo(onset_envelope=self.feature("onset_env", decomp),
+                                                     sr=self.samplingrate, hop_length=self.hop_length, aggregate=None)
+            elif name == "times":
+                compute = lambda: librosa.times_like(self.feature("dtempo", decomp), sr=self.samplingrate,
+                                                     hop_length=self.hop_length)
+            elif name == "onset_frames":
+                compute = lambda: librosa.onset.onset_detect(onset_envelope=self.feature("onset_env", decomp),
+                                                             sr=self.samplingrate, hop_length=self.hop_length)
+            else:
+                raise ValueError(f"Unknown analysis feature {name}")
+            with instrumentation.span(name, self.stages, decomp=decomp):
+                features[name] = self._cached("features", name, compute, decomp=decomp)
+
+        return features[name]
+
+    def clear_analysis(self, *decomps):
+        '''
+        Invalidate cached analysis features so they are recalculated on next use
+
+        :param decomps: signals to clear (None, "harmonic" or "percussive"), clears everything if none are given
+        '''
+        if len(decomps) == 0:
+            self._analysis_cache = {}
+        else:
+            self._analysis_cache = {k: v for k, v in self._analysis_cache.items() if k[0] not in decomps}
 
     def time_to_synthmap(self, time_elapsed, rounding=None):
         '''
@@ -65,23 +241,9 @@ class MapConversion:
 
         :time_elapsed: float or numpy array, actual time in audio file
         :rounding: int 2, 4, 8, etc. Instead of rounding to 1/64, snap notes to nearest 1/4, 1/8, etc.
-        :return: positions in 1/64 increments as np array of strings, z coordinates as np array
+        :return: positions in 1/64 increments as np array of ints, z coordinates as np array
         '''
-
-        # convert seconds to number of increments
-        position = np.round((time_elapsed + self.offset) * self.increment).astype(int)
-
-        if rounding is None:
-            # z's do not need to be modified, these are seconds * 20
-            z = (time_elapsed + self.offset) * 2 * 10
-        else:
-            # round the positions to the required step, and calculate the corrected z timing
-            rounding = 64 / rounding
-            position = (rounding * np.round(position / rounding)).astype(int)
-            z = position * 20 / self.increment
-
-        position = position.astype(str)  # string labels
-        return position, z
+        return quantize(time_elapsed, self.bpm, offset=self.offset, rounding=rounding)
 
     def tempos(self, chart=False):
         '''
@@ -91,13 +253,15 @@ class MapConversion:
         :return: mode of bpm values as float
         '''
 
-        onset_env = librosa.onset.onset_strength(y=self.y, sr=self.samplingrate)
-        # find the dynamic tempo
-        dtempo = librosa.beat.tempo(onset_envelope=onset_env, sr=self.samplingrate, aggregate=None)
+        dtempo = self.feature("dtempo")
 
         if chart:
+            import matplotlib.pyplot as plt
+            # Thematic! (This is just for ambiance in plots)
+            import mplcyberpunk
+
             plt.style.use("cyberpunk")
-            plt.plot(np.linspace(0, librosa.get_duration(y=self.y, sr=self.samplingrate) / 60, dtempo.size), dtempo)
+            plt.plot(np.linspace(0, self.duration / 60, dtempo.size), dtempo)
             plt.title("Detected BPM")
             plt.xlabel("Minutes")
             plt.ylabel("BPM")
@@ -105,38 +269,110 @@ class MapConversion:
             plt.show()
 
         # and return the mode
+        from scipy import stats as st
         return st.mode(dtempo, keepdims=True).mode[0]
 
-    def tempo_breakdown(self):
-        '''Find chunks of common tempo and return them with estimated time windows'''
-        onset_env = librosa.onset.onset_strength(y=self.y, sr=self.samplingrate)
-        # find the dynamic tempo
-        dtempo = librosa.beat.tempo(onset_envelope=onset_env, sr=self.samplingrate, aggregate=None)
-        timings = librosa.times_like(dtempo)
+    def estimate_offset(self, resolution=64):
+        '''
+        Estimate the offset by tracking beats at the current bpm and finding the phase of the beat grid that best fits
+        them. Uses the onset envelope from tempo detection, so this adds very little to the analysis time.
 
-        # this should get the starting indices for each tempo sequence
-        start_idx = np.nonzero(np.r_[1, np.diff(dtempo)[:-1]])
+        :resolution: number of candidate phases per beat
+        :return: offset in seconds, between 0 and one beat
+        '''
+        onset_env = self.feature("onset_env")
+        with instrumentation.span("beat_track", self.stages):
+            _, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=self.samplingrate,
+                                               hop_length=self.hop_length, bpm=self.bpm)
+        beat_times = librosa.frames_to_time(beats, sr=self.samplingrate, hop_length=self.hop_length)
+        # stronger beats count for more
+        return grid_offset(beat_times, self.bpm, weights=onset_env[beats], resolution=resolution)
 
-        data = np.array([dtempo[start_idx], timings[start_idx]]).T
+    def tempo_breakdown(self):
+        '''Find chunks of common tempo and return them with estimated time windows'''
+        data = np.array(tempo_segments(self.feature("dtempo"), self.feature("times"))).T
 
+        import pandas as pd
         return pd.DataFrame(data, columns=["BPM", "Time"])
 
     def notes(self, audio_series):
         '''
         Detect note positions and extract timestamps
+
+        :param audio_series: the standard file or one of its components (array or None, "harmonic", "percussive"),
+                            or any other signal array, which will not be cached
         '''
+        if isinstance(audio_series, np.ndarray):
+            # reuse the cached analysis if this is one of our own signals
+            known = {None: self.y, "harmonic": self._harmonic, "percussive": self._percussive}
+            matches = [k for k, v in known.items() if v is audio_series]
+            if len(matches) > 0:
+                frames = self.feature("onset_frames", matches[0])
+            else:
+                frames = librosa.onset.onset_detect(y=audio_series, sr=self.samplingrate, hop_length=self.hop_length)
+        else:
+            frames = self.feature("onset_frames", audio_series)
 
-        self.timestamps = librosa.onset.onset_detect(y=audio_series, sr=self.samplingrate, units="time")
+        self.timestamps = librosa.frames_to_time(frames, sr=self.samplingrate, hop_length=self.hop_length)
 
     def use_decomp(self, decomp):
-        if decomp == "harmonic":
-            self.notes(self.harmonic)
-        elif decomp == "percussive":
-            self.notes(self.percussive)
-        else:
-            self.notes(self.y)
+        '''
+        Detect notes on the original signal or one of its components. Decompositions are only calculated when
+        requested, and are reused if they have already been calculated.
+
+        :param decomp: None for the standard file, "harmonic" or "percussive"
+        '''
+        if decomp not in ["harmonic", "percussive"]:
+            decomp = None
+        self.decomposition = decomp
+        self.notes(decomp)
+
+    @property
+    def analysis(self):
+        '''
+        Analysis result for the current timestamps. It doesn't depend on bpm, offset or rounding, so any number of maps
+        can be generated from it without touching the audio again, see note_columns() and generate_variants().
+        A new result is made whenever the timestamps are replaced, e.g. by use_decomp().
 
-    def generate_beatmap(self, path, rounding=None):
+        :return: OnsetAnalysis
+        '''
+        if self._analysis is None or self._analysis_of is not self.timestamps:
+            self._analysis = OnsetAnalysis(onset_times=self.timestamps, decomposition=self.decomposition,
+                                           tempo_curve=self._tempo_curve)
+            self._analysis_of = self.timestamps
+        return self._analysis
+
+    def _tempo_curve(self):
+        '''Dynamic tempo and the times of its frames, a method rather than a lambda so converters can be pickled'''
+        return self.feature("dtempo"), self.feature("times")
+
+    def note_columns(self, rounding=None, bpm=None, offset=None, variable_bpm=False):
+        '''
+        Build the guide notes for the current timestamps as columns, one right (type 0) and one left (type 1) note per
+        beat. Onsets that land on the same position are merged, keeping the earliest.
+        Only the analysis result is re-quantized, so bpm and offset can be changed here without any audio analysis.
+
+        :rounding: integer increment to round to, otherwise everything will be to the nearest 64th
+        :bpm: beats per minute, defaults to self.bpm
+        :offset: offset in seconds, defaults to self.offset
+        :variable_bpm: if True, snap each note to the grid of its own tempo segment from tempo_breakdown(), the
+                    positions are still given in 1/64 increments of bpm
+        :return: dict of numpy arrays "position", "x", "y", "z" and "type", sorted by position
+        '''
+        bpm = self.bpm if bpm is None else bpm
+        offset = self.offset if offset is None else offset
+        analysis = self.analysis
+        with instrumentation.span("quantize", self.stages):
+            if variable_bpm:
+                positions, z_vals, _ = analysis.quantize_segments(bpm, offset=offset, rounding=rounding)
+            else:
+                positions, z_vals = analysis.quantize(bpm, offset=offset, rounding=rounding)
+            positions, first = np.unique(positions, return_index=True)
+            z_vals = np.asarray(z_vals, dtype=float)[first]
+
+        return guide_note_columns(positions, z_vals)
+
+    def generate_beatmap(self, path, rounding=None, precision=None, variable_bpm=False):
         '''
         Convert timestamp data to beatmap notes and generate json output file
         Round to nearest 1/n beat (optional) using an integer increment in rounding, e.g. 2 for 1/2 increments,
@@ -146,38 +382,506 @@ class MapConversion:
 
         :path: path to json file
         :rounding: integer increment to round to, otherwise everything will be to the nearest 64th
+        :precision: number of decimals to round coordinates to in the json, full precision if None
+        :variable_bpm: if True, snap notes to the grid of their own tempo segment, see note_columns()
         '''
-        positions, z_vals = self.time_to_synthmap(self.timestamps, rounding=rounding)
-        notes = [[{"Position": [0.202, 0, z], "Segments": None, "Type": 0}, {"Position": [-0.108, 0, z], "Segments": None, "Type": 1}] for z in z_vals]
-
-        beatmap = {
-            "BPM": self.bpm,
-            "startMeasure": 0,
-            "startTime": 0,
-            "lenght": self.timestamps[-1] * 1000,  # largest time value in milliseconds
-            "notes": dict(zip(positions, notes)),
-            "effects": [],
-            "jumps": [],
-            "crouchs": [],
-            "squares": [],
-            "triangles": [],
-            "slides": [],
-            "lights": [],
-        }
-
-        json_string = json.dumps(beatmap)
-        with open(path, "w") as outfile:
-            outfile.write(json_string)
+        columns = self.note_columns(rounding=rounding, variable_bpm=variable_bpm)
+        with instrumentation.span("write", self.stages):
+            # largest time value in milliseconds
+            write_beatmap(path, columns, self.bpm, self.timestamps[-1] * 1000, precision=precision)
+
+    def generate_variants(self, path_template, variants, precision=None):
+        '''
+        Write several beatmaps with different rounding, bpm or offset from the same analysis in one call
+
+        :path_template: path for each json file, formatted with the settings of the variant,
+                        e.g. "beatmap_{bpm:.2f}_{rounding}.json"
+        :variants: list of dicts with any of "rounding", "bpm", "offset" and "variable_bpm", missing values use the
+                current settings
+        :precision: number of decimals to round coordinates to in the json, full precision if None
+        :return: list of paths written
+        '''
+        paths = []
+        for variant in variants:
+            settings = {"rounding": None, "bpm": self.bpm, "offset": self.offset, "variable_bpm": False, **variant}
+            path = path_template.format(**settings)
+            columns = self.note_columns(**settings)
+            with instrumentation.span("write", self.stages):
+                write_beatmap(path, columns, settings["bpm"], self.timestamps[-1] * 1000, precision=precision)
+            paths.append(path)
+        return paths
+
+    def generate_difficulties(self, path_template="{difficulty}_beatmap.json", difficulties=None, precision=None):
+        '''
+        Write a beatmap for each difficulty from the current timestamps in one call, see downmap()
+
+        :path_template: path for each json file, formatted with the name of the difficulty
+        :difficulties: dict of difficulty name: {"subdivision": notes per beat, "min_gap": beats}, defaults to
+                    DIFFICULTIES
+        :precision: number of decimals to round coordinates to in the json, full precision if None
+        :return: dict of difficulty name: path written
+        '''
+        difficulties = DIFFICULTIES if difficulties is None else difficulties
+        positions = np.unique(self.analysis.quantize(self.bpm, offset=self.offset)[0])
+        with instrumentation.span("downmap", self.stages):
+            snapped, keep = downmap(positions, [d["subdivision"] for d in difficulties.values()],
+                                    [d["min_gap"] for d in difficulties.values()])
+
+        paths = {}
+        increment = self.bpm * 64 / 60
+        for n, name in enumerate(difficulties):
+            kept = snapped[n, keep[n]]
+            path = path_template.format(difficulty=name)
+            with instrumentation.span("write", self.stages, difficulty=name):
+                write_beatmap(path, guide_note_columns(kept, kept * 20 / increment), self.bpm,
+                              self.timestamps[-1] * 1000, precision=precision)
+            paths[name] = path
+        return paths
+
+
+@dataclass(frozen=True)
+class OnsetAnalysis:
+    '''
+    Detected onsets and tempo curve of a track, independent of bpm, offset and rounding. The arrays are read-only, so
+    one result can be shared and re-quantized any number of times.
+
+    onset_times: onset timestamps in seconds
+    decomposition: signal the onsets were detected on, None, "harmonic" or "percussive"
+    tempo_curve: function with no arguments returning the tempo and tempo_times arrays. It is only called when the
+                tempo curve is first needed, e.g. by quantize_segments(), since detecting it takes about as long as
+                the onsets.
+    tempo: dynamic tempo (bpm) for each frame
+    tempo_times: time of each tempo frame in seconds
+    '''
+    onset_times: np.ndarray
+    decomposition: str = None
+    tempo_curve: object = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "onset_times", _read_only(self.onset_times))
+
+    @cached_property
+    def _tempo(self):
+        tempo, tempo_times = self.tempo_curve()
+        return _read_only(tempo), _read_only(tempo_times)
+
+    @property
+    def tempo(self):
+        return self._tempo[0]
+
+    @property
+    def tempo_times(self):
+        return self._tempo[1]
+
+    def quantize(self, bpm, offset=0, rounding=None):
+        '''Editor positions and z coordinates of the onsets, see quantize()'''
+        return quantize(self.onset_times, bpm, offset=offset, rounding=rounding)
+
+    def quantize_segments(self, bpm, offset=0, rounding=None):
+        '''Editor positions, z coordinates and tempo segments of the onsets, snapped per segment, see quantize_segments()'''
+        segment_bpm, segment_start = tempo_segments(self.tempo, self.tempo_times)
+        return quantize_segments(self.onset_times, segment_bpm, segment_start, bpm, offset=offset, rounding=rounding)
+
+
+def _read_only(array):
+    '''Read-only view of an array, the array itself is left alone'''
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+
+def guide_note_columns(positions, z_vals):
+    '''
+    Guide note columns with one right (type 0) and one left (type 1) note at each position, see write_beatmap()
+
+    :param positions: sorted unique positions in 1/64 increments
+    :param z_vals: z coordinate of each position
+    :return: dict of numpy arrays "position", "x", "y", "z" and "type"
+    '''
+    return {
+        "position": np.repeat(positions, 2),
+        "x": np.tile([0.202, -0.108], positions.size),
+        "y": np.zeros(2 * positions.size),
+        "z": np.repeat(z_vals, 2),
+        "type": np.tile([0, 1], positions.size),
+    }
+
+
+# grid in notes per beat and smallest gap between notes in beats of each difficulty made by generate_difficulties()
+DIFFICULTIES = {
+    "Easy": {"subdivision": 1, "min_gap": 2},
+    "Normal": {"subdivision": 2, "min_gap": 1},
+    "Hard": {"subdivision": 4, "min_gap": 0.5},
+    "Expert": {"subdivision": 8, "min_gap": 0.25},
+}
+
+
+def downmap(positions, subdivisions, min_gaps, snap=True):
+    '''
+    Thin one set of note positions for several difficulties at once. For each difficulty, notes are snapped to its
+    grid (or dropped if they aren't on it), the earliest note on each grid position is kept, and then notes closer
+    than the minimum gap to the last kept note are dropped.
+
+    :param positions: sorted note positions in 1/64 increments
+    :param subdivisions: grid of each difficulty in notes per beat, e.g. [1, 2, 4, 8]
+    :param min_gaps: smallest gap between notes of each difficulty in beats
+    :param snap: if False, only keep notes that are already on the grid of a difficulty
+    :return: positions on each difficulty's grid and a mask of the notes it keeps, both difficulties x notes
+    '''
+    positions = np.asarray(positions)
+    step = 64 / np.asarray(subdivisions, dtype=float)[:, None]
+    # grids like triplets fall between 1/64 increments, so round to the nearest one instead of truncating
+    snapped = np.round(step * np.round(positions[None, :] / step)).astype(int)
+    if snap:
+        keep = np.ones(snapped.shape, dtype=bool)
+        # one note per grid position
+        keep[:, 1:] = np.diff(snapped, axis=1) > 0
+    else:
+        keep = snapped == positions[None, :]
+
+    gaps = np.asarray(min_gaps, dtype=float) * 64
+    for n in range(snapped.shape[0]):
+        if gaps[n] <= 0:
+            continue
+        candidates = np.flatnonzero(keep[n])
+        candidate_positions = snapped[n, candidates]
+        keep[n] = False
+        # jump from each kept note straight to the first one far enough after it
+        i = 0
+        while i < candidates.size:
+            keep[n, candidates[i]] = True
+            i = np.searchsorted(candidate_positions, candidate_positions[i] + gaps[n])
+    return snapped, keep
+
+
+def quantize(time_elapsed, bpm, offset=0, rounding=None):
+    '''
+    Convert timestamps to beatmap timings. If working with a known fixed bpm and maximum note separation,
+    use rounding to snap notes to nearest beat.
+
+    :param time_elapsed: float or numpy array, actual time in audio file
+    :param bpm: beats per minute
+    :param offset: offset in seconds
+    :param rounding: int 2, 4, 8, etc. Instead of rounding to 1/64, snap notes to nearest 1/4, 1/8, etc.
+    :return: positions in 1/64 increments as np array of ints, z coordinates as np array
+    '''
+    increment = bpm * 64 / 60  # 1/64th increments per sec
+
+    # convert seconds to number of increments
+    position = np.round((time_elapsed + offset) * increment).astype(int)
+
+    if rounding is None:
+        # z's do not need to be modified, these are seconds * 20
+        z = (time_elapsed + offset) * 2 * 10
+    else:
+        # round the positions to the required step, and calculate the corrected z timing
+        rounding = 64 / rounding
+        position = (rounding * np.round(position / rounding)).astype(int)
+        z = position * 20 / increment
+
+    return position, z
+
+
+def grid_offset(beat_times, bpm, weights=None, resolution=64):
+    '''
+    Find the offset that best aligns a fixed bpm grid with a set of beat times. Every candidate phase is scored
+    against every beat at once.
+
+    :param beat_times: numpy array of beat times in seconds
+    :param bpm: beats per minute of the grid
+    :param weights: optional weight for each beat
+    :param resolution: number of candidate phases per beat
+    :return: offset in seconds, so that (beat time + offset) falls on the grid, between 0 and one beat
+    '''
+    beat_times = np.asarray(beat_times, dtype=float)
+    if beat_times.size == 0:
+        return 0.0
+    weights = np.ones(beat_times.size) if weights is None else np.asarray(weights, dtype=float)
+
+    period = 60 / bpm
+    phases = np.arange(resolution) * period / resolution
+    # distance from each beat to the nearest grid line, for each candidate phase (candidates x beats)
+    distance = (beat_times[None, :] - phases[:, None] + period / 2) % period - period / 2
+    phase = phases[np.argmin(np.abs(distance).dot(weights))]
+
+    return float((period - phase) % period)
+
+
+def tempo_segments(dtempo, timings):
+    '''
+    Find chunks of common tempo in a dynamic tempo curve
+
+    :param dtempo: bpm for each frame
+    :param timings: time of each frame in seconds
+    :return: bpm and start time of each segment as numpy arrays
+    '''
+    # this should get the starting indices for each tempo sequence
+    start_idx = np.nonzero(np.r_[1, np.diff(dtempo)[:-1]])
+    return dtempo[start_idx], timings[start_idx]
+
+
+def quantize_segments(time_elapsed, segment_bpm, segment_start, bpm, offset=0, rounding=None):
+    '''
+    Convert timestamps to beatmap timings for a track with a variable tempo. Each onset is assigned to its tempo
+    segment and snapped to that segment's beat grid, all in one pass over the arrays.
+
+    Beats are counted continuously across segments, so the grid doesn't jump at tempo changes. Unlike quantize(), the
+    z coordinates are always those of the snapped time.
+
+    :param time_elapsed: numpy array, actual time in audio file
+    :param segment_bpm: bpm of each segment
+    :param segment_start: start time of each segment in seconds, increasing
+    :param bpm: beats per minute the map is written at, positions are in 1/64 increments of this bpm
+    :param offset: offset in seconds
+    :param rounding: int 2, 4, 8, etc. to snap to the nearest 1/2, 1/4, 1/8 beat of the segment, 1/64 if None
+    :return: positions in 1/64 increments as np array of ints, z coordinates as np array, segment index of each onset
+    '''
+    time_elapsed = np.asarray(time_elapsed, dtype=float)
+    segment_bpm = np.asarray(segment_bpm, dtype=float)
+    segment_start = np.asarray(segment_start, dtype=float)
+    subdivision = 64 if rounding is None else rounding
+
+    # beat count at the start of each segment, the first beat is at -offset
+    segment_beats = np.cumsum(np.r_[(segment_start[0] + offset) * segment_bpm[0] / 60,
+                                    np.diff(segment_start) * segment_bpm[:-1] / 60])
+
+    segment = np.maximum(np.searchsorted(segment_start, time_elapsed, side="right") - 1, 0)
+    beats = segment_beats[segment] + (time_elapsed - segment_start[segment]) * segment_bpm[segment] / 60
+
+    # snap within the segment, and convert back to time
+    snapped = np.round(beats * subdivision) / subdivision
+    snapped_time = segment_start[segment] + (snapped - segment_beats[segment]) * 60 / segment_bpm[segment]
+
+    position, z = quantize(snapped_time, bpm, offset=offset)
+    return position, z, segment
+
+
+def write_beatmap(path, columns, bpm, length, precision=None):
+    '''
+    Write single notes given as columns to a Synth Riders json file. The json is streamed to the file from the arrays,
+    so no intermediate dict is built for the notes.
+
+    :param path: path to json file
+    :param columns: dict of equal length numpy arrays "position" (1/64 increments), "x", "y", "z" and "type"
+    :param bpm: beats per minute
+    :param length: length of the map in milliseconds
+    :param precision: number of decimals to round coordinates to, full precision if None
+    '''
+    if precision is not None:
+        columns = {k: serialization.round_floats(v, precision) for k, v in columns.items()}
+
+    # group notes by position, keeping the original order within each position
+    order = np.argsort(columns["position"], kind="stable")
+    position = columns["position"][order]
+    starts = np.flatnonzero(np.r_[True, position[1:] != position[:-1]]) if position.size > 0 else np.array([], int)
+    ends = np.r_[starts[1:], position.size]
+
+    notes = [f'{{"Position": [{x!r}, {y!r}, {z!r}], "Segments": null, "Type": {t}}}'
+             for x, y, z, t in zip(columns["x"][order].tolist(), columns["y"][order].tolist(),
+                                   columns["z"][order].tolist(), columns["type"][order].tolist())]
+    keys = position[starts].tolist()
+
+    with open(path, "w") as outfile:
+        outfile.write(f'{{"BPM": {serialization.dumps(bpm)}, "startMeasure": 0, "startTime": 0, "lenght": {serialization.dumps(length)}, '
+                      '"notes": {')
+        outfile.writelines(f'{", " if n > 0 else ""}"{key}": [{", ".join(notes[start:end])}]'
+                           for n, (key, start, end) in enumerate(zip(keys, starts, ends)))
+        outfile.write('}, "effects": [], "jumps": [], "crouchs": [], "squares": [], "triangles": [], "slides": [], '
+                      '"lights": []}')
+
+
+# sources produced by each Spleeter model
+STEM_NAMES = {2: ["vocals", "accompaniment"],
+              4: ["vocals", "drums", "bass", "other"],
+              5: ["vocals", "drums", "bass", "piano", "other"]}
+# stem used to detect bpm and offset for each model
+REFERENCE_STEMS = {2: "accompaniment", 4: "drums", 5: "drums"}
+
+# Spleeter separators by stem count, shared by every SplitAudio so each model is only loaded once per process
+_separators = {}
+
+
+def get_separator(split):
+    """
+    Get the shared Spleeter separator for a number of stems, creating it on first use
+
+    :param split: 2, 4 or 5 stems
+    :return: spleeter Separator
+    """
+    if split not in _separators:
+        from spleeter.separator import Separator
+        _separators[split] = Separator(f'spleeter:{split}stems')
+    return _separators[split]
+
+
+def separate_stems(filename, split, sr=22050, write_stems=False, cache=None, stages=None):
+    """
+    Separate a track with Spleeter. Each source is downmixed and resampled once, ready for analysis.
+
+    :param filename: path to audio file
+    :param split: 2, 4 or 5 stems
+    :param sr: sampling rate of the returned sources
+    :param write_stems: if True, save each source as spleeter_output/<file name>/<source>.wav
+    :param cache: optional AnalysisCache, stems from a previous run are reused unless they need writing to disk
+    :param stages: list to append instrumentation records to
+    :return: dict of source name: mono waveform at sr
+    """
+    # stems from a previous run, unless they need writing to disk again
+    if cache is not None and not write_stems:
+        key = cache.key(cache.file_hash(filename), stage="separate", split=split, sr=sr)
+        stems = {name: cache.get(key, name) for name in STEM_NAMES[split]}
+        if all(stem is not None for stem in stems.values()):
+            return stems
+
+    from spleeter.audio.adapter import AudioAdapter
+
+    with instrumentation.span("load model", stages, split=split):
+        separator = get_separator(split)
+    audio_adapter = AudioAdapter.default()
+    with instrumentation.span("load", stages):
+        # Spleeter models work at 44.1 kHz
+        waveform, spleeter_rate = audio_adapter.load(filename, sample_rate=44100)
+    #TODO: preprocess audio to remove quiet sound artefacts from other tracks
+    with instrumentation.span("separate", stages, split=split):
+        sources = separator.separate(waveform)
+
+    if write_stems:
+        output_path = Path("spleeter_output") / Path(filename).stem
+        output_path.mkdir(parents=True, exist_ok=True)
+        for key in sources:
+            audio_adapter.save(str(output_path / f"{key}.wav"), sources[key], spleeter_rate, "wav")
+
+    with instrumentation.span("resample", stages):
+        stems = {key: librosa.resample(librosa.to_mono(sources[key].T), orig_sr=spleeter_rate, target_sr=sr)
+                 for key in sources}
+    if cache is not None:
+        key = cache.key(cache.file_hash(filename), stage="separate", split=split, sr=sr)
+        for name in stems:
+            cache.put(key, name, stems[name])
+    return stems
+
+
+def batch_onset_strength(tracks, sr, hop_length=512, cache=None):
+    """
+    Onset envelopes of several waveforms computed together, if they can be stacked
+
+    :param tracks: dict of track name: audio file or mono waveform array
+    :param sr: sampling rate of the waveforms
+    :param hop_length: hop between frames
+    :param cache: optional AnalysisCache, tracks whose envelope is already cached are left out
+    :return: dict of track name: onset envelope, empty unless every track is a waveform of the same length and at
+            least two of them aren't cached
+    """
+    signals = list(tracks.values())
+    if sr is None or len(signals) < 2 or \
+            not all(isinstance(y, np.ndarray) and y.ndim == 1 and y.shape == signals[0].shape for y in signals):
+        return {}
+    if cache is not None:
+        # same entries as MapConversion._cached, which loads the cached ones itself
+        tracks = {name: y for name, y in tracks.items()
+                  if cache.get(cache.key(cache.array_hash(y), stage="features", sr=sr, hop_length=hop_length,
+                                         decomp=None), "onset_env") is None}
+        if len(tracks) < 2:
+            return {}
+    with instrumentation.span("stacked onset_env", tracks=len(tracks)):
+        envelopes = stacked_onset_strength(np.stack(list(tracks.values())), sr, hop_length=hop_length)
+    return dict(zip(tracks, envelopes))
+
+
+def _build_converter(filename, bpm, offset, decomposition, sr, cache, instrument=None):
+    """
+    Worker task for convert_stems, module level so it can be pickled
+
+    :param instrument: instrumentation.worker_settings() of the parent, stages are recorded on the converter if set
+    """
+    if instrument is None:
+        return MapConversion(filename, bpm=bpm, offset=offset, decomposition=decomposition, sr=sr, cache=cache)
+    with instrumentation.collecting(**instrument):
+        return MapConversion(filename, bpm=bpm, offset=offset, decomposition=decomposition, sr=sr, cache=cache)
+
+
+def _write_beatmap(path, columns, bpm, length, instrument=None):
+    """
+    Worker task for SplitAudio.generate_all_maps, only the note columns are sent to the worker
+
+    :return: records of the write, to be added to the stages of the converter in the parent
+    """
+    if instrument is None:
+        write_beatmap(path, columns, bpm, length)
+        return []
+    with instrumentation.collecting(**instrument) as sink:
+        with instrumentation.span("write"):
+            write_beatmap(path, columns, bpm, length)
+    return sink.records
+
+
+def convert_stems(tracks, bpm=None, offset=None, decomposition=None, reference=None, workers=1, sr=None,
+                  cache=None):
+    """
+    Create a MapConversion object for each of a set of tracks that share a bpm and offset.
+    If the bpm or offset are unknown, the reference track is analysed first and its values are used for the others.
+
+    :param tracks: dict of track name: audio file or mono waveform array
+    :param bpm: beats per minute, if known
+    :param offset: offset in seconds, if known
+    :param decomposition: None, "harmonic" or "percussive"
+    :param reference: name of the track used to detect bpm and offset
+    :param workers: number of processes for the remaining tracks, 1 runs everything in this process and computes the
+                    onset envelopes of same-length waveforms together, see batch_onset_strength()
+    :param sr: sampling rate, required if the tracks are waveform arrays
+    :param cache: optional AnalysisCache for the analysis of each track
+    :return: dict of track name: MapConversion, and the bpm and offset used
+    """
+    maps = {}
+    onset_envs = {}
+    if workers <= 1 and decomposition is None:
+        # stems of one track share their length, so the spectrograms of all of them are computed in one pass
+        onset_envs = batch_onset_strength(tracks, sr, cache=cache)
+
+    if bpm is None or offset is None:
+        # generate the first map and update the bpm automatically
+        maps[reference] = MapConversion(tracks[reference], bpm=bpm, offset=offset, decomposition=decomposition,
+                                        sr=sr, cache=cache, onset_env=onset_envs.get(reference))
+        bpm = maps[reference].bpm
+        # detected on the reference track if it wasn't given
+        offset = maps[reference].offset
+
+    # generate all of the other maps, exclude any keys that already exist
+    keys = [key for key in tracks if key not in maps]
+    if workers > 1 and len(keys) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            instrument = instrumentation.worker_settings()
+            futures = [executor.submit(_build_converter, tracks[key], bpm, offset, decomposition, sr, cache,
+                                       instrument)
+                       for key in keys]
+            for key, future in zip(keys, futures):
+                maps[key] = future.result()
+                # pass on what the worker recorded
+                instrumentation.emit(maps[key].stages)
+    else:
+        for key in keys:
+            maps[key] = MapConversion(tracks[key], bpm=bpm, offset=offset, decomposition=decomposition, sr=sr,
+                                      cache=cache, onset_env=onset_envs.get(key))
+
+    return maps, bpm, offset
 
 
 class SplitAudio:
-    def __init__(self, filename, split=2, bpm=None, offset=None, decomposition=None):
+    def __init__(self, filename, split=2, bpm=None, offset=None, decomposition=None, workers=1, write_stems=False,
+                 map_prefix="", cache=None):
         """
         Contains a dictionary of MapConversion objects with audio from multiple source tracks
-        Spleeter is used to generate separate .wav files for each source in the audio
+        Spleeter is used to separate the audio into sources, which are kept in memory and analysed directly
+
+        :param workers: number of processes used to analyse and export the stems, 1 runs everything serially
+        :param write_stems: if True, also save each source as a .wav file in spleeter_output/
+        :param map_prefix: prepended to the name of each generated json file
+        :param cache: optional AnalysisCache, separated stems and their analysis are stored there and reused
+
+        While instrumentation is enabled, timings of the separation are kept in self.stages and those of each stem's
+        analysis in the stages of its MapConversion, see stage_breakdown().
         """
 
-        Path("/spleeter_output").mkdir(parents=True, exist_ok=True)
         valid_splits = [2, 4, 5]
         if split not in valid_splits:
             print(f"split must be 2, 4, or 5, but received {split}. Set to default 2.")
@@ -187,54 +891,81 @@ class SplitAudio:
 
         self.bpm = bpm
         self.offset = offset
+        self.workers = workers
+        self.map_prefix = map_prefix
+        self.cache = cache
+        self.samplingrate = 22050  # librosa's default, used for all analysis
+        self.stages = []
 
-        self.separate_track(filename)
-
-        # get all of the generated tracks
-        working_dir = Path.cwd()
-        track_path = Path(working_dir / "spleeter_output"/f"{filename[:-4]}")
-        tracks = list(track_path.rglob("*.wav"))
-        self.track_select = dict(zip([t.name[:-4] for t in tracks], tracks))
+        # separated sources as mono waveforms
+        self.track_select = self.separate_track(filename, write_stems=write_stems)
 
         # generate MapConversion objects and generate json files for all
         self.beatmap_generators = self.generate_converters(decomposition)
         self.generate_all_maps()
 
+    def separate_track(self, filename, write_stems=False):
+        """
+        Separate tracks with Spleeter and perform some preprocessing, see separate_stems()
 
-    def separate_track(self, filename):
+        :param filename: path to audio file
+        :param write_stems: if True, save each source as spleeter_output/<file name>/<source>.wav
+        :return: dict of source name: mono waveform at self.samplingrate
         """
-        Separate tracks with Spleeter and perform some preprocessing
+        return separate_stems(filename, self.split, sr=self.samplingrate, write_stems=write_stems, cache=self.cache,
+                              stages=self.stages)
+
+    @classmethod
+    def batch(cls, filenames, split=2, **kwargs):
         """
-        separator = Separator(f'spleeter:{self.split}stems')
-        #TODO: preprocess audio to remove quiet sound artefacts from other tracks
-        separator.separate_to_file(filename, "spleeter_output")
+        Separate and map several audio files with the same settings, using one loaded Spleeter model for all of them
 
+        :param filenames: list of paths to audio files
+        :param split: 2, 4 or 5 stems
+        :param kwargs: any other SplitAudio arguments
+        :return: dict of file name: SplitAudio
+        """
+        # json files are named after the source, so keep each song's maps apart
+        return {filename: cls(filename, split=split, map_prefix=f"{Path(filename).stem}_", **kwargs)
+                for filename in filenames}
 
     def generate_converters(self, decomposition):
         """
         Create a separate MapConversion object for each track
         """
-        maps = {}
-        if self.bpm is None or self.offset is None:
-            bpm_source_select = {2: "accompaniment", 4: "drums", 5: "drums"}
-            # generate the first map and update the bpm automatically
-            maps[bpm_source_select[self.split]] = MapConversion(self.track_select[bpm_source_select[self.split]],
-                                                                bpm=self.bpm, offset=self.offset,
-                                                                decomposition=decomposition)
-            self.bpm = maps[bpm_source_select[self.split]].bpm
-            # future proofing: will update offset once automatic offset detection is working
-            self.offset = maps[bpm_source_select[self.split]].offset
-
-        # generate all of the other maps, exclude any keys that already exist
-        for key in self.track_select:
-            if key not in maps:
-                maps[key] = MapConversion(self.track_select[key], bpm=self.bpm, offset=self.offset,
-                                          decomposition=decomposition)
+        maps, self.bpm, self.offset = convert_stems(self.track_select, bpm=self.bpm, offset=self.offset,
+                                                    decomposition=decomposition,
+                                                    reference=REFERENCE_STEMS[self.split], workers=self.workers,
+                                                    sr=self.samplingrate, cache=self.cache)
         return maps
 
     def generate_all_maps(self):
         """
         Create a json file for each track. Uses settings from each track individually, so these can be modified.
         """
-        for key in self.beatmap_generators:
-            self.beatmap_generators[key].generate_beatmap(f"{key}_beatmap.json")
\ No newline at end of file
+        paths = {key: f"{self.map_prefix}{key}_beatmap.json" for key in self.beatmap_generators}
+        if self.workers > 1 and len(paths) > 1:
+            instrument = instrumentation.worker_settings()
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # quantize here, sending the converters would copy their waveforms and features to the workers
+                futures = {}
+                for key in paths:
+                    converter = self.beatmap_generators[key]
+                    futures[key] = executor.submit(_write_beatmap, paths[key], converter.note_columns(), converter.bpm,
+                                                   converter.timestamps[-1] * 1000, instrument)
+                for key, future in futures.items():
+                    records = future.result()
+                    self.beatmap_generators[key].stages.extend(records)
+                    instrumentation.emit(records)
+        else:
+            for key in paths:
+                self.beatmap_generators[key].generate_beatmap(paths[key])
+
+    def stage_breakdown(self):
+        """
+        Recorded timings of the separation and of each stem's analysis
+
+        :return: dict of "separation" or stem name: list of stage records
+        """
+        return {"separation": self.stages,
+                **{key: converter.stages for key, converter in self.beatmap_generators.items()}}
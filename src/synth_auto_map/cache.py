@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+
+'''On-disk cache for audio analysis results.
+
+    Entries are keyed by a hash of the audio content, the analysis parameters and the versions of the libraries that
+    produced them, so changing any of those never returns stale results. Arrays are stored as .npy files and loaded
+    memory-mapped, so a warm run reads only the pages it uses. Entries that haven't been used recently are evicted
+    once the cache grows past its size limit.'''
+
+
+def library_versions(packages=("numpy", "librosa", "spleeter")):
+    """Installed versions of the libraries that affect analysis results, read without importing them"""
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class AnalysisCache:
+    def __init__(self, directory=None, max_bytes=2 * 1024 ** 3):
+        """
+        Content-addressed store of numpy arrays. Each entry is a directory holding one or more named arrays.
+
+        :param directory: where to keep the cache, defaults to ~/.cache/synth_auto_map
+        :param max_bytes: size limit, least recently used entries are removed once it's exceeded
+        """
+        self.directory = Path(directory) if directory is not None else Path.home() / ".cache" / "synth_auto_map"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.versions = library_versions()
+        # file hashes by (path, size, modification time), so unchanged files are only read once
+        self._file_hashes = {}
+
+    def file_hash(self, path):
+        """SHA-256 of a file's content"""
+        stat = os.stat(path)
+        file_id = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._file_hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self._file_hashes[file_id] = digest.hexdigest()
+        return self._file_hashes[file_id]
+
+    @staticmethod
+    def array_hash(array):
+        """SHA-256 of an array's content, shape and type"""
+        digest = hashlib.sha256(np.ascontiguousarray(array).tobytes())
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        return digest.hexdigest()
+
+    def key(self, content_hash, **params):
+        """
+        Entry key for some content and the parameters used to analyse it
+
+        :param content_hash: hash of the source audio, see file_hash() and array_hash()
+        :param params: anything that changes the result, must be json serializable
+        :return: hex string
+        """
+        description = json.dumps({"content": content_hash, "versions": self.versions, **params}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key, name):
+        """
+        Load a cached array, memory-mapped and read-only
+
+        :return: numpy array, or None if it isn't cached
+        """
+        path = self.directory / key / f"{name}.npy"
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        # record the access for eviction
+        os.utime(path.parent)
+        return array
+
+    def put(self, key, name, array):
+        """Store an array, then evict old entries if the cache is too large"""
+        entry = self.directory / key
+        entry.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so other processes never see a partial array
+        fd, temp_path = tempfile.mkstemp(dir=entry, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(temp_path, entry / f"{name}.npy")
+        os.utime(entry)
+        self.evict(keep=key)
+
+    def get_or_compute(self, key, name, compute):
+        """
+        Load a cached array, or compute and store it if it isn't cached
+
+        :param compute: function with no arguments returning a numpy array
+        :return: numpy array
+        """
+        array = self.get(key, name)
+        if array is None:
+            array = compute()
+            self.put(key, name, array)
+        return array
+
+    def size(self):
+        """Total size of the cache in bytes"""
+        return sum(f.stat().st_size for f in self.directory.glob("*/*.npy"))
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+
+        :param keep: key of an entry that must not be removed
+        """
+        entries = []
+        total = 0
+        for entry in self.directory.iterdir():
+            if entry.is_dir():
+                entry_size = sum(f.stat().st_size for f in entry.glob("*.npy"))
+                entries.append((entry.stat().st_mtime, entry_size, entry))
+                total += entry_size
+
+        for _, entry_size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= entry_size
+
+    def clear(self):
+        """Remove every entry"""
+        for entry in self.directory.iterdir():
+            if entry.is_dir():
+                shutil.rmtree(entry, ignore_errors=True)
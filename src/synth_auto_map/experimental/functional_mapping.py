@@ -1,33 +1,120 @@
 import numpy as np
 import synth_mapping_helper as smh
 
+from .helper_extensions import RailIndex
+
 
 # functions for generating various shapes from time vectors
+def rotation_angle(t, velocity_modifier=1):
+    '''
+    Angle travelled around a circle at each time, relative to the first time
+
+    :param t: numpy array of time coordinates in beats, time is the last axis
+    :param velocity_modifier: float or array broadcastable to t. 1 gives one full rotation every four beats. Varying
+                            velocities are integrated over time, so the rotation stays continuous.
+    :return: numpy array of angles in radians, same shape as t
+    '''
+    t = np.asarray(t, dtype=float)
+    velocity = np.asarray(velocity_modifier, dtype=float) * np.pi / 2
+    if velocity.ndim == 0:
+        return velocity * (t - t[..., :1])
+    velocity = np.broadcast_to(velocity, t.shape)
+    # trapezoidal integral of the angular velocity
+    steps = 0.5 * (velocity[..., 1:] + velocity[..., :-1]) * np.diff(t, axis=-1)
+    return np.concatenate([np.zeros(t.shape[:-1] + (1,)), np.cumsum(steps, axis=-1)], axis=-1)
+
+
+def _per_pattern(values, t):
+    '''Add a time axis to values given once per pattern of a batch, so they broadcast against t'''
+    values = np.asarray(values, dtype=float)
+    if t.ndim > 1 and values.ndim == t.ndim - 1:
+        return values[..., None]
+    return values
+
+
+def spiral_nodes(t, r, velocity_modifier=1, start_angle=0, center=(0, 0)):
+    '''
+    Generate spiral patterns around center lines, for any number of patterns at once.
+    Every argument is broadcast against t, so give t a leading axis (patterns x times) to generate a batch. For a
+    batch, r and velocity_modifier with one value per pattern (shape t.shape[:-1]) apply to the whole pattern, give
+    them the full shape of t for values per node.
+
+    :param t: numpy array of time coordinates in beats, time is the last axis
+    :param r: float or array of radii in grid increments. Positive radii rotate counter clockwise, negative ones
+            clockwise.
+    :param velocity_modifier: float or array of velocities around the circle, see rotation_angle()
+    :param start_angle: float or array (one per pattern) of starting angles in degrees, counter clockwise from the
+                        right (+x) of the circle
+    :param center: xy coordinates of the center, shape (2,) or (..., n, 2), e.g. from centers_along_rail()
+    :return: numpy array (..., n, 3) of xy and time, ready for to_rail() or to_notes()
+    '''
+    t = np.asarray(t, dtype=float)
+    r = _per_pattern(r, t)
+    velocity_modifier = _per_pattern(velocity_modifier, t)
+    start_angle = np.asarray(start_angle, dtype=float)
+    if start_angle.ndim > 0:
+        # one angle per pattern
+        start_angle = start_angle[..., None]
+
+    # the sign of the radius sets the direction, so changing it mid-pattern doesn't jump across the circle
+    velocity_modifier = velocity_modifier * np.where(r < 0, -1.0, 1.0)
+    angle = rotation_angle(t, velocity_modifier) + start_angle * np.pi / 180
+    r = np.abs(r)
+    center = np.asarray(center, dtype=float)
+    return np.stack([r * np.cos(angle) + center[..., 0], r * np.sin(angle) + center[..., 1], t * np.ones_like(r)],
+                    axis=-1)
+
+
 def spiralize(t, r, velocity_modifier=1, start_angle=0, center=np.array([0,0]).reshape(1,2)):
     '''
     Generate a spiral pattern around a center line, with variable rotational velocity and radius
-    Center line coordinates could be generated with a rail in the editor, but should be interpolated for proper timing
+    Center line coordinates could be generated with a rail in the editor, but should be interpolated for proper timing,
+    see centers_along_rail()
 
     :param t: n x 1 numpy array of time coordinates
-    :param r: float or n x 1 numpy array representing radii in grid increments. If negative, rotate counter clockwise.
+    :param r: float or n x 1 numpy array representing radii in grid increments. If positive, rotate counter
+            clockwise, if negative, rotate clockwise.
     :param velocity_modifier: float or n x 1 numpy array representing note velocity around the circle. 1 gives one
                             full rotation every four beats (measures) to make it easy to speed up.
-    :param start_angle: starting angle in degrees clockwise from top of circle.
+    :param start_angle: starting angle in degrees counter clockwise from the right (+x) of the circle.
     :param center: n x 2 numpy array of xy coordinates to act as centers. If only a single center is used, a 1x2 array.
     :return: 3xn numpy array of coordinates
     '''
+    t = np.ravel(t)
+    r = np.ravel(r) if np.ndim(r) > 0 else r
+    velocity_modifier = np.ravel(velocity_modifier) if np.ndim(velocity_modifier) > 0 else velocity_modifier
+    return spiral_nodes(t, r, velocity_modifier, start_angle, np.reshape(center, (-1, 2))).T
 
-    # adjust starting angle to work with -r
-    if r<0:
-        start_angle = start_angle + 180
 
-    start_angle = start_angle * np.pi / 180
+def centers_along_rail(rail, t):
+    '''
+    Positions along a rail at a set of times, e.g. as centers for spiral_nodes().
+    Uses the same spline as the editor, times outside the rail get the position of its nearest end.
 
-    velocity_modifier = velocity_modifier * np.pi / 2
+    :param rail: numpy array (n, 3) of rail nodes, e.g. a value of DataContainer.right
+    :param t: numpy array of times in beats, any shape
+    :return: numpy array of xy coordinates, shape t.shape + (2,)
+    '''
+    t = np.asarray(t, dtype=float)
+    clipped = np.clip(t, rail[0, 2], rail[-1, 2])
+    return RailIndex({rail[0, 2]: rail}).positions(clipped.ravel()).reshape(t.shape + (2,))
 
-    x_vals = r * np.cos(velocity_modifier * (t - t[0]) + start_angle) + center[:][0]
-    y_vals = r * np.sin(velocity_modifier * (t - t[1]) + start_angle) + center[:][1]
-    return np.array([x_vals, y_vals, t])
 
+def to_rail(nodes):
+    '''
+    Single color notes dict with one rail through the nodes, to put in a DataContainer
+
+    :param nodes: numpy array (n, 3), e.g. from spiral_nodes()
+    :return: dict of start time: nodes
+    '''
+    return {nodes[0, 2]: nodes}
 
 
+def to_notes(nodes):
+    '''
+    Single color notes dict with a note at each node, to put in a DataContainer
+
+    :param nodes: numpy array (n, 3), e.g. from spiral_nodes()
+    :return: dict of time: (1, 3) array
+    '''
+    return {z: nodes[i:i + 1] for i, z in enumerate(nodes[:, 2].tolist())}
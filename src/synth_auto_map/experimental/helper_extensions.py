@@ -1,11 +1,11 @@
-import synth_mapping_helper as smh
 from synth_mapping_helper.synth_format import *
 
+from .. import serialization
+
 
 # variants for manipulating files, allows use of functions on more than one json file simultaneously.
 def import_file(path) -> DataContainer:
-    f = open(path)
-    original_json = json.load(f)
+    original_json = serialization.load(path)
     data = original_json
 
     bpm = data["BPM"]
@@ -31,7 +31,7 @@ def import_file(path) -> DataContainer:
     return DataContainer(original_json, bpm, *notes, walls)
 
 
-def export_file(data: DataContainer, path, realign_start: bool = True):
+def export_file(data: DataContainer, path, realign_start: bool = True, precision: int = None):
     output_json = {
         "BPM": data.bpm,
         "startMeasure": 0,
@@ -76,40 +76,123 @@ def export_file(data: DataContainer, path, realign_start: bool = True):
     # always update length
     output_json["lenght"] = (last - first) * MS_PER_MIN / data.bpm
 
-    final_output = json.dumps(output_json)
-    with open(path, "w") as outfile:
-        outfile.write(final_output)
+    serialization.dump(output_json, path, precision=precision)
 
 
 """EXPERIMENTAL: The following functions are not well tested"""
 
-# Additional movement functions allowing arbitrary position reassignment
-def arbitrary_xy(data: "numpy array (1, 3)", new_locs: dict) -> "numpy array (1, 3)":
-    '''
-    Makes snap-to rail work. Reposition to a set of xy coordinates given in a dictionary.
-    Dictionary keys correspond to the time coordinate
-    '''
-    data[0, :2] = new_locs[data[0, 2]]
-    return data
+def _pchip_slope(d1, d2, h1, h2):
+    '''Derivative at a node between two segments with slopes d1, d2 and lengths h1, h2, as in scipy's pchip'''
+    w1 = 2 * h2 + h1
+    w2 = h2 + 2 * h1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (w1 + w2) / (w1 / d1 + w2 / d2)
+    # flat at local extrema
+    return np.where((np.sign(d1) != np.sign(d2)) | (d1 == 0) | (d2 == 0), 0.0, slope)
+
+
+class RailIndex:
+    def __init__(self, notes: SINGLE_COLOR_NOTES):
+        '''
+        Precomputed lookup of positions along the rails and notes of one color, for evaluating many times at once.
+        Uses the same spline as smh.rails.get_position_at: pchip through the nodes of a rail, continued in a straight
+        line past the end of the last rail, and through the notes on either side of a gap between single notes. The
+        results are the same as get_position_at for one rail or for single notes. With several rails, a gap after a
+        rail is interpolated through the next rail or note, where get_position_at keeps extending the first rail.
+        Rails of one color shouldn't overlap, a rail is cut where the next one starts.
+
+        :param notes: dict of time: nodes, e.g. DataContainer.right
+        '''
+        starts = sorted(notes)
+        nodes = [notes[t] for t in starts]
+        for n in range(len(nodes) - 1):
+            nodes[n] = nodes[n][nodes[n][:, 2] < starts[n + 1]]
+        nodes = [n for n in nodes if n.shape[0] > 0]
+
+        # all nodes in time order, with the rail (or note) each belongs to
+        all_nodes = np.concatenate(nodes) if nodes else np.empty((0, 3))
+        self.z = all_nodes[:, 2]
+        self.xy = all_nodes[:, :2]
+        item = np.repeat(np.arange(len(nodes)), [n.shape[0] for n in nodes])
+        # a final rail continues along its last segment, there is nothing after a final single note
+        self.extends = item.size > 1 and item[-1] == item[-2]
+
+        # secant of each segment between consecutive nodes, on a rail or in a gap
+        h = np.diff(self.z)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = np.diff(self.xy, axis=0) / h[:, None]
+        d[h == 0] = 0
+        # The spline of a rail is padded with straight extensions and the spline in a gap runs through the rail or
+        # note on either side, so a node without a neighbour on the same side takes the slope of the segment itself.
+        self.left_slope = d.copy()
+        self.right_slope = d.copy()
+        if h.size > 1:
+            inner = _pchip_slope(d[:-1], d[1:], h[:-1, None], h[1:, None])
+            # derivative at the start of segments 1.., where the previous node is part of the same item
+            has_previous = item[:-2] == item[1:-1]
+            self.left_slope[1:][has_previous] = inner[has_previous]
+            # derivative at the end of segments ..-2, where the next node is part of the same item
+            has_next = item[2:] == item[1:-1]
+            self.right_slope[:-1][has_next] = inner[has_next]
+
+    def positions(self, times) -> "numpy array (n, 2)":
+        '''
+        Positions at a set of times
+
+        :param times: numpy array of times in beats
+        :return: xy for each time, nan before the first node, and after the last one unless it ends a rail
+        '''
+        times = np.asarray(times, dtype=float)
+        out = np.full((times.size, 2), np.nan)
+        if self.z.size == 0:
+            return out
+        inside = (times >= self.z[0]) & (times <= self.z[-1])
+        if self.z.size == 1:
+            out[inside] = self.xy[0]
+            return out
+
+        t = times[inside]
+        segment = np.clip(np.searchsorted(self.z, t, side="right") - 1, 0, self.z.size - 2)
+        h = (self.z[segment + 1] - self.z[segment])[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = np.where(h > 0, (t[:, None] - self.z[segment, None]) / h, 0.0)
+        # cubic hermite basis
+        h00 = (1 + 2 * s) * (1 - s) ** 2
+        h10 = s * (1 - s) ** 2
+        h01 = s ** 2 * (3 - 2 * s)
+        h11 = s ** 2 * (s - 1)
+        out[inside] = h00 * self.xy[segment] + h10 * h * self.left_slope[segment] + \
+            h01 * self.xy[segment + 1] + h11 * h * self.right_slope[segment]
+        if self.extends:
+            after = times > self.z[-1]
+            out[after] = self.xy[-1] + (times[after, None] - self.z[-1]) * self.right_slope[-1]
+        return out
 
 
 def snap_to_rail(beats, rail_patterns):
-    '''snap existing notes to a rail of the same color'''
+    '''
+    snap existing notes to a rail of the same color.
+    Notes before the first rail or note of their color, or after a final single note, are moved to [0, 0]. Notes
+    after a final rail follow its last segment in a straight line.
+    '''
 
     categories = ["both", "left", "right", "single"]
 
     for c in categories:
-        times = getattr(beats, c)
-        repositioning_map = {n: (smh.rails.get_position_at(getattr(rail_patterns, c), n)
-                                 if smh.rails.get_position_at(getattr(rail_patterns, c), n) is not None
-                                 else np.array([0, 0])) for n in times.keys()}
-        beats.apply_for_notes(arbitrary_xy, repositioning_map, types=[c])
+        notes = getattr(beats, c)
+        if not notes:
+            continue
+        positions = RailIndex(getattr(rail_patterns, c)).positions(np.fromiter(notes.keys(), float, len(notes)))
+        positions[np.isnan(positions[:, 0])] = 0
+        for nodes, xy in zip(notes.values(), positions):
+            nodes[0, :2] = xy
+        setattr(beats, c, dict(sorted(notes.items())))
 
 
 #TODO: add helper functions
 #
 # For downmapping:
-# Thinning (keep only notes on mod 32 subdivision etc.)
+# Thinning existing maps (keep only notes on mod 32 subdivision etc.), generated maps can use beat_finder.downmap
 # Compressing the map
 # Changing crossover patterns to parallel
 #
@@ -0,0 +1,159 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from glob import has_magic, iglob
+from importlib import import_module
+from pathlib import Path
+import argparse
+import os
+import time
+
+from .. import instrumentation
+from .helper_extensions import import_file, export_file
+
+'''Apply a chain of transforms to many beatmap json files in a process pool.
+
+    A transform is any function taking a DataContainer, which either modifies it in place (like snap_to_rail) or
+    returns a new one. Extra arguments can be bound with functools.partial, as long as the function is importable so
+    it can be sent to the workers. Files are read by the workers as they are picked up and written as soon as they
+    are transformed.'''
+
+
+def transform_name(transform):
+    """Name of a transform for timing summaries, also for functools.partial objects"""
+    return getattr(transform, "__name__", None) or getattr(getattr(transform, "func", None), "__name__", None) \
+        or repr(transform)
+
+
+def glob_root(pattern):
+    """Directory a glob pattern searches from: its leading components without wildcards"""
+    parts = Path(pattern).parts
+    for i, part in enumerate(parts):
+        if has_magic(part):
+            return Path(*parts[:i]) if i > 0 else Path(".")
+    return Path(pattern).parent
+
+
+def _transform_file(path, output_path, transforms, realign_start, precision):
+    """Worker task for transform_files: load, transform and write one file, timing each step"""
+    with instrumentation.collecting() as sink:
+        with instrumentation.span("import_file", file=str(path)):
+            data = import_file(path)
+        for transform in transforms:
+            with instrumentation.span(transform_name(transform), file=str(path)):
+                result = transform(data)
+            if result is not None:
+                data = result
+        with instrumentation.span("export_file", file=str(path)):
+            export_file(data, output_path, realign_start=realign_start, precision=precision)
+    return str(output_path), sink.records
+
+
+def transform_files(pattern, transforms, output_dir=".", suffix="", workers=None, realign_start=True,
+                    precision=None):
+    '''
+    Apply a chain of transforms to every beatmap json file matching a glob pattern.
+    Timing for each file is printed as files complete, followed by the total time spent in each transform. Files
+    that fail are reported and skipped, the others are still transformed.
+    Outputs keep their path relative to the directory the pattern searches from, so "maps/**/*.json" writes
+    maps/a/x.json to <output_dir>/a/x<suffix>.json and files with the same name in different folders don't collide.
+
+    :param pattern: glob pattern, e.g. "maps/**/*.json", or a list of paths
+    :param transforms: list of functions taking a DataContainer, applied in order
+    :param output_dir: directory for the transformed files, created if needed. Must differ from the searched
+                    directory unless a suffix is given, so the inputs aren't overwritten.
+    :param suffix: appended to the name of each output file, e.g. "_snapped"
+    :param workers: number of processes, defaults to the number of CPUs
+    :param realign_start: see export_file()
+    :param precision: number of decimals to round coordinates to, full precision if None
+    :return: dict of input path: output path for the files that were transformed, and dict of step name: total
+            seconds
+    '''
+    if isinstance(pattern, str):
+        root = glob_root(pattern)
+        paths = iglob(pattern, recursive=True)
+    else:
+        pattern = list(pattern)
+        root = Path(os.path.commonpath([str(Path(path).parent) for path in pattern])) if pattern else None
+        paths = iter(pattern)
+    output_root = Path(output_dir).resolve()
+    if not suffix and root is not None and output_root == root.resolve():
+        raise ValueError(f"output_dir {output_dir} is where the input files are, give a suffix or another directory")
+    # outputs that the pattern can list again: the ones written by this run, and with a suffix, earlier ones in an
+    # output_dir inside the searched tree
+    written = set()
+    outputs_searched = bool(suffix) and root is not None and \
+        (output_root == root.resolve() or root.resolve() in output_root.parents)
+    results = {}
+    totals = {}
+    failed = 0
+    start = time.perf_counter()
+    workers = workers if workers is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # only keep a couple of files per worker queued, so huge catalogues aren't all listed and submitted up front
+        max_pending = 2 * workers
+        pending = {}
+        while True:
+            for path in paths:
+                resolved = Path(path).resolve()
+                if resolved in written or (outputs_searched and resolved.stem.endswith(suffix)
+                                           and output_root in resolved.parents):
+                    continue
+                relative = Path(path).relative_to(root)
+                output_path = Path(output_dir) / relative.parent / f"{relative.stem}{suffix}.json"
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                written.add(output_path.resolve())
+                pending[executor.submit(_transform_file, path, output_path, transforms, realign_start,
+                                        precision)] = path
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    output_path, records = future.result()
+                except Exception as error:
+                    failed += 1
+                    print(f"{path}: failed, {type(error).__name__}: {error}")
+                    continue
+                results[path] = output_path
+                instrumentation.emit(records)
+                steps = ", ".join(f"{record['name']} {record['wall']:.3f} s" for record in records)
+                print(f"{path}: {sum(record['wall'] for record in records):.2f} s ({steps})")
+                for record in records:
+                    totals[record["name"]] = totals.get(record["name"], 0.0) + record["wall"]
+
+    elapsed = time.perf_counter() - start
+    print(f"Transformed {len(results)} files in {elapsed:.2f} s ({len(results) / max(elapsed, 1e-9):.2f} files/s)")
+    for name, seconds in totals.items():
+        print(f"    {name}: {seconds:.2f} s")
+    if failed:
+        print(f"{failed} files could not be transformed")
+    return results, totals
+
+
+def load_transform(spec):
+    """Import a transform given as module:function, e.g. my_transforms:mirror"""
+    module, _, name = spec.partition(":")
+    return getattr(import_module(module), name)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Apply transforms to many Synth Riders beatmap json files")
+    parser.add_argument("pattern", help="glob pattern of json files, quote it so the shell doesn't expand it")
+    parser.add_argument("-t", "--transform", action="append", dest="transforms", required=True,
+                        help="transform as module:function, can be repeated. Applied in order.")
+    parser.add_argument("-o", "--output-dir", default=".", help="directory for the transformed files")
+    parser.add_argument("-s", "--suffix", default="", help="appended to each output file name")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("-p", "--precision", type=int, default=None, help="decimals to round coordinates to")
+    options = parser.parse_args(args)
+
+    transform_files(options.pattern, [load_transform(spec) for spec in options.transforms],
+                    output_dir=options.output_dir, suffix=options.suffix, workers=options.workers,
+                    precision=options.precision)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from . import serialization
+
+'''Named timing spans for the analysis stages.
+
+    Stages are wrapped in span() blocks, which record wall time, CPU time and, while tracemalloc is tracing, the peak
+    memory allocated during the block. Records are sent to every enabled sink and appended to the stage list of the
+    object doing the work (MapConversion.stages, SplitAudio.stages). Nothing is recorded until a sink is enabled, so
+    disabled spans don't even read the clock.
+
+    Spans can be nested, the outer span's times and peak include the inner ones.'''
+
+# enabled sinks, see enable()
+_sinks = []
+# whether tracemalloc was started by enable(), so disable() knows to stop it
+_started_tracing = False
+# open spans of each thread, [allocated at start, highest peak seen] so nested spans can reset the tracemalloc peak
+_local = threading.local()
+
+
+class MemorySink:
+    def __init__(self):
+        """Keeps every record in a list"""
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def totals(self):
+        """Wall time, CPU time and highest peak for each span name, summed over all records with that name"""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["name"], {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_bytes": None})
+            total["count"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            if record["peak_bytes"] is not None:
+                total["peak_bytes"] = max(total["peak_bytes"] or 0, record["peak_bytes"])
+        return totals
+
+    def clear(self):
+        self.records = []
+
+
+class LogSink:
+    def __init__(self, logger=None):
+        """
+        Writes one line per record
+
+        :param logger: logging.Logger to write to at INFO level, printed if None
+        """
+        self.logger = logger
+
+    def __call__(self, record):
+        tags = "".join(f" {k}={v}" for k, v in record.items() if k not in ("name", "wall", "cpu", "peak_bytes"))
+        peak = "" if record["peak_bytes"] is None else f", {record['peak_bytes'] / 1024 ** 2:.1f} MB peak"
+        message = f"{record['name']}{tags}: {record['wall']:.3f}s wall, {record['cpu']:.3f}s cpu{peak}"
+        if self.logger is None:
+            print(message)
+        else:
+            self.logger.info(message)
+
+
+class JSONLinesSink:
+    def __init__(self, path):
+        """
+        Appends each record to a file as one line of JSON
+
+        :param path: path to the file, created if it doesn't exist
+        """
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, "a") as f:
+            f.write(serialization.dumps(record) + "\n")
+
+
+def enable(sink, memory=False):
+    """
+    Start sending span records to a sink
+
+    :param sink: any callable taking a record dict, e.g. MemorySink, LogSink or JSONLinesSink
+    :param memory: if True, start tracemalloc so spans record their peak allocation. Tracing slows down every
+                allocation, so this is off by default.
+    :return: the sink
+    """
+    global _started_tracing
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    _sinks.append(sink)
+    return sink
+
+
+def disable(sink=None):
+    """
+    Stop sending records to a sink
+
+    :param sink: sink to remove, removes all of them if None
+    """
+    global _started_tracing
+    if sink is None:
+        _sinks.clear()
+    elif sink in _sinks:
+        _sinks.remove(sink)
+    if not _sinks and _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+
+def enabled():
+    """True if spans are being recorded"""
+    return len(_sinks) > 0
+
+
+@contextmanager
+def collecting(memory=False):
+    """
+    Send records only to a new MemorySink for the duration of a with block. Meant for worker processes, which may
+    have inherited the parent's sinks, so the parent can pass the records on with emit().
+
+    :param memory: see enable()
+    :return: the MemorySink
+    """
+    saved = _sinks[:]
+    sink = MemorySink()
+    _sinks[:] = [sink]
+    start_tracing = memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    try:
+        yield sink
+    finally:
+        _sinks[:] = saved
+        if start_tracing:
+            tracemalloc.stop()
+
+
+def worker_settings():
+    """Settings to pass to a worker process so it can record spans with collecting(), None if disabled"""
+    return {"memory": tracemalloc.is_tracing()} if _sinks else None
+
+
+def emit(records):
+    """Send records to every enabled sink, e.g. ones collected in a worker process"""
+    for record in records:
+        for sink in _sinks:
+            sink(record)
+
+
+@contextmanager
+def span(name, stages=None, **tags):
+    """
+    Record the wall time, CPU time and peak allocation of a with block
+
+    :param name: name of the stage
+    :param stages: list to append the record to, e.g. the stage list of the object doing the work
+    :param tags: anything else to include in the record, must be json serializable
+    """
+    if not _sinks:
+        yield
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak_bytes = None
+        if tracing:
+            start, seen = stack.pop()
+            # tracing may have been stopped inside the block
+            if tracemalloc.is_tracing():
+                peak = max(seen, tracemalloc.get_traced_memory()[1])
+                peak_bytes = peak - start
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+
+        record = {"name": name, **tags, "wall": wall, "cpu": cpu, "peak_bytes": peak_bytes}
+        if stages is not None:
+            stages.append(record)
+        emit([record])
@@ -0,0 +1,218 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from . import instrumentation
+from .beat_finder import MapConversion, REFERENCE_STEMS, _build_converter, separate_stems
+
+'''Asyncio interface for mapping many tracks at once.
+
+    Each track goes through the same steps as SplitAudio: Spleeter separation, bpm and offset detection on the
+    reference stem, analysis of the other stems and a beatmap per stem. Separation and analysis run in a shared
+    process pool, beatmaps are written from threads so file I/O overlaps with the analysis of other stems. Finished
+    beatmaps are returned as soon as they are written, so a slow track doesn't hold back the others.'''
+
+
+@dataclass
+class StemMap:
+    '''
+    A finished beatmap, or the error that stopped a track
+
+    filename: source audio file
+    stem: Spleeter source the map was generated from
+    path: json file written
+    converter: MapConversion of the stem, with the bpm and offset used and the recorded stages
+    error: exception raised while processing the track, stem, path and converter are None if set
+    '''
+    filename: str
+    stem: str = None
+    path: str = None
+    converter: MapConversion = None
+    error: Exception = None
+
+
+# marks the end of a track in the result queue
+_TRACK_DONE = object()
+# marks the end of the filenames in the result queue of map()
+_ALL_SUBMITTED = object()
+
+
+def _separate(filename, split, sr, cache, instrument):
+    """Worker task, separation and the instrumentation records of the worker"""
+    if instrument is None:
+        return separate_stems(filename, split, sr=sr, cache=cache), []
+    stages = []
+    with instrumentation.collecting(**instrument):
+        stems = separate_stems(filename, split, sr=sr, cache=cache, stages=stages)
+    return stems, stages
+
+
+class TrackJobs:
+    def __init__(self, split=2, workers=None, max_tracks=None, bpm=None, offset=None, decomposition=None,
+                 output_dir=".", cache=None):
+        """
+        Concurrent version of SplitAudio for many tracks. Use as an async context manager:
+
+            async with TrackJobs(split=4, workers=8) as jobs:
+                async for result in jobs.map(filenames):
+                    print(result.filename, result.stem, result.path)
+
+        :param split: 2, 4 or 5 stems
+        :param workers: number of processes for separation and analysis, defaults to the number of cores
+        :param max_tracks: number of tracks in progress at once, later tracks wait for a free slot. Each one holds its
+                        separated stems in memory, and with map() a track keeps its slot until its results have
+                        been consumed. Defaults to the number of workers.
+        :param bpm: beats per minute of every track, detected per track if None
+        :param offset: offset in seconds of every track, detected per track if None
+        :param decomposition: None, "harmonic" or "percussive"
+        :param output_dir: where to write the json files, named <file name>_<stem>_beatmap.json
+        :param cache: optional AnalysisCache for separated stems and their analysis
+        """
+        if split not in REFERENCE_STEMS:
+            raise ValueError(f"split must be 2, 4, or 5, but received {split}")
+        self.split = split
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.max_tracks = max_tracks if max_tracks is not None else self.workers
+        self.bpm = bpm
+        self.offset = offset
+        self.decomposition = decomposition
+        self.output_dir = Path(output_dir)
+        self.cache = cache
+        self.samplingrate = 22050  # librosa's default, used for all analysis
+
+        self._executor = None
+        self._slots = None
+
+    async def __aenter__(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = asyncio.Semaphore(self.max_tracks)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # work that hasn't started yet is dropped, running tasks finish in the background
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    async def _convert(self, audio, bpm, offset, instrument):
+        """Analyse one stem in the pool"""
+        loop = asyncio.get_running_loop()
+        converter = await loop.run_in_executor(self._executor, _build_converter, audio, bpm, offset,
+                                               self.decomposition, self.samplingrate, self.cache, instrument)
+        instrumentation.emit(converter.stages)
+        return converter
+
+    async def _write(self, filename, stem, converter):
+        """Write a stem's beatmap from a thread"""
+        path = self.output_dir / f"{Path(filename).stem}_{stem}_beatmap.json"
+        await asyncio.to_thread(converter.generate_beatmap, str(path))
+        return StemMap(filename, stem=stem, path=str(path), converter=converter)
+
+    async def _process(self, filename, results):
+        """Separate, analyse and export one track, putting each finished StemMap on the results queue"""
+        loop = asyncio.get_running_loop()
+        instrument = instrumentation.worker_settings()
+        tasks = []
+        try:
+            stems, records = await loop.run_in_executor(self._executor, _separate, filename, self.split,
+                                                        self.samplingrate, self.cache, instrument)
+            instrumentation.emit(records)
+
+            bpm, offset = self.bpm, self.offset
+            keys = list(stems)
+            if bpm is None or offset is None:
+                # the other stems need the reference's bpm and offset
+                reference = REFERENCE_STEMS[self.split]
+                converter = await self._convert(stems[reference], bpm, offset, instrument)
+                bpm, offset = converter.bpm, converter.offset
+                keys.remove(reference)
+                tasks.append(asyncio.ensure_future(self._write(filename, reference, converter)))
+
+            async def convert_and_write(key):
+                return await self._write(filename, key, await self._convert(stems[key], bpm, offset, instrument))
+
+            tasks += [asyncio.ensure_future(convert_and_write(key)) for key in keys]
+            for task in asyncio.as_completed(tasks):
+                await results.put(await task)
+        except Exception as error:
+            await results.put(StemMap(filename, error=error))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await results.put(_TRACK_DONE)
+
+    async def map(self, filenames, return_exceptions=False):
+        """
+        Process tracks concurrently, at most max_tracks at a time, and yield beatmaps as they are written.
+        Stopping the iteration early cancels everything that is still running.
+
+        :param filenames: iterable of paths to audio files
+        :param return_exceptions: if True, a failing track yields a StemMap with its error instead of raising it
+        :return: async generator of StemMap, in order of completion
+        """
+        if self._executor is None:
+            raise RuntimeError("TrackJobs must be used in an async with block")
+        results = asyncio.Queue()
+        tasks = []
+        all_submitted = asyncio.Event()
+
+        async def submit():
+            try:
+                for filename in filenames:
+                    # backpressure: wait for a free slot before starting the next track. Slots are released as
+                    # the consumer reaches the end of a track's results, so a slow consumer holds back new tracks.
+                    await self._slots.acquire()
+                    tasks.append(asyncio.create_task(self._process(filename, results)))
+            finally:
+                all_submitted.set()
+                await results.put(_ALL_SUBMITTED)
+
+        submitter = asyncio.create_task(submit())
+        finished = 0
+        try:
+            while not (all_submitted.is_set() and finished == len(tasks)):
+                result = await results.get()
+                if result is _ALL_SUBMITTED:
+                    continue
+                if result is _TRACK_DONE:
+                    finished += 1
+                    self._slots.release()
+                    continue
+                if result.error is not None and not return_exceptions:
+                    raise result.error
+                yield result
+            # raise anything that went wrong while iterating over filenames
+            await submitter
+        finally:
+            submitter.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(submitter, *tasks, return_exceptions=True)
+            # free the slots of tracks whose results weren't all consumed
+            for _ in range(len(tasks) - finished):
+                self._slots.release()
+
+    async def convert(self, filename):
+        """
+        Process one track, waiting for a free slot first. Several calls can run concurrently, e.g. with
+        asyncio.gather, and share the pool and the max_tracks limit.
+
+        :param filename: path to audio file
+        :return: list of StemMap, one per stem
+        """
+        if self._executor is None:
+            raise RuntimeError("TrackJobs must be used in an async with block")
+        results = asyncio.Queue()
+        async with self._slots:
+            await self._process(filename, results)
+
+        maps = []
+        while not results.empty():
+            result = results.get_nowait()
+            if result is _TRACK_DONE:
+                continue
+            if result.error is not None:
+                raise result.error
+            maps.append(result)
+        return maps
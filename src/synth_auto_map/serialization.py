@@ -0,0 +1,92 @@
+import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''JSON reading and writing for beatmaps and Audio Trip files.
+
+    Uses orjson when it is installed, which is much faster on the float-heavy note and rail data, and falls back to
+    the standard library otherwise. Both backends accept non-string keys (positions are often ints) and numpy values.
+    Floats can optionally be rounded to a number of decimals to shrink the output.'''
+
+BACKENDS = ["orjson", "json"] if orjson is not None else ["json"]
+# used when no backend is given
+default_backend = BACKENDS[0]
+
+
+def _check_backend(backend):
+    backend = default_backend if backend is None else backend
+    if backend not in BACKENDS:
+        raise ValueError(f"JSON backend must be one of {BACKENDS}, but received {backend}")
+    return backend
+
+
+def _to_builtin(obj):
+    """Convert numpy values for the standard library encoder"""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def round_floats(obj, precision):
+    """
+    Round every float in nested dicts and lists
+
+    :param obj: dict, list, numpy array or value
+    :param precision: number of decimals
+    :return: copy of obj with rounded floats
+    """
+    if isinstance(obj, float):
+        return round(obj, precision)
+    elif isinstance(obj, dict):
+        return {k: round_floats(v, precision) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [round_floats(v, precision) for v in obj]
+    elif isinstance(obj, np.ndarray) and obj.dtype.kind == "f":
+        return np.round(obj, precision)
+    return obj
+
+
+def loads(data, backend=None):
+    """
+    Parse a JSON document
+
+    :param data: str or bytes
+    :param backend: "orjson" or "json", the fastest available if None
+    :return: parsed object
+    """
+    if _check_backend(backend) == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, precision=None, backend=None):
+    """
+    Serialize an object to a JSON string
+
+    :param obj: object to serialize, may contain numpy arrays and non-string keys
+    :param precision: number of decimals to round floats to, full precision if None
+    :param backend: "orjson" or "json", the fastest available if None
+    :return: str
+    """
+    if precision is not None:
+        obj = round_floats(obj, precision)
+    if _check_backend(backend) == "orjson":
+        return orjson.dumps(obj, default=_to_builtin,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, default=_to_builtin)
+
+
+def load(path, backend=None):
+    """Read a JSON file, see loads()"""
+    with open(path, "rb") as f:
+        return loads(f.read(), backend=backend)
+
+
+def dump(obj, path, precision=None, backend=None):
+    """Write an object to a JSON file, see dumps()"""
+    with open(path, "w") as outfile:
+        outfile.write(dumps(obj, precision=precision, backend=backend))